@@ -1,5 +1,10 @@
 import os
+import re
+import sys
+import hashlib
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import plotly
@@ -9,6 +14,11 @@ import plotly.express as px
 
 
 class BaseCompare:
+    # Set to a dict to share loaded results frames across calls, e.g., one visualize per column category
+    cache = None
+    # Set to a dtype map (see dictionary_dtype_map) to read results csvs with compact dtypes
+    dtype_map = None
+
     def __init__(self, base_folder, feature_folder, export_folder, export_file):
         self.base_folder = base_folder
         self.feature_folder = feature_folder
@@ -27,15 +37,270 @@ class BaseCompare:
                 df1[col] = np.nan
         return df1[cols]
 
+    @staticmethod
+    def align_rows(df1, df2):
+        # Inner join both frames on their index in one pass, keeping the row order of df1
+        if not (df1.index.is_unique and df2.index.is_unique):
+            df1 = df1[df1.index.isin(df2.index)]
+            return df1, df2[df2.index.isin(df1.index)]
+
+        index = df1.index.intersection(df2.index)
+        if not index.equals(df1.index):
+            df1 = df1.take(df1.index.get_indexer(index))
+        if not index.equals(df2.index):
+            df2 = df2.take(df2.index.get_indexer(index))
+        return df1, df2
+
+    @staticmethod
+    def align_chunks(base_chunks, feature_chunks):
+        # Inner join two streams of index-sorted frames, yielding row-aligned (base, feature) chunks. Only the rows
+        # past the smallest last key read from either stream are buffered.
+        streams = [iter(base_chunks), iter(feature_chunks)]
+        buffers = [None, None]
+        done = [False, False]
+        emitted = False
+
+        def last(i):
+            if buffers[i] is None or buffers[i].empty:
+                return None
+            return buffers[i].index[-1]
+
+        while not all(done):
+            # Read from the stream that is behind
+            i = 0 if done[1] or (not done[0] and (last(0) is None or (last(1) is not None and last(0) <= last(1)))) else 1
+            chunk = next(streams[i], None)
+            if chunk is None:
+                done[i] = True
+            else:
+                if not chunk.index.is_monotonic_increasing or \
+                        (last(i) is not None and not chunk.empty and chunk.index[0] < last(i)):
+                    raise ValueError('Chunked comparison requires files sorted by their index.')
+                buffers[i] = chunk if buffers[i] is None else pd.concat([buffers[i], chunk])
+
+            if any(buffer is None for buffer in buffers):
+                continue
+
+            bounds = [last(j) for j in range(2) if not done[j]]
+            if None in bounds:
+                continue
+
+            heads = []
+            for j in range(2):
+                n = len(buffers[j]) if not bounds else buffers[j].index.searchsorted(min(bounds), side='right')
+                heads.append(buffers[j].iloc[:n])
+                buffers[j] = buffers[j].iloc[n:]
+
+            base_df, feature_df = BaseCompare.align_rows(heads[0], heads[1])
+            if not base_df.empty:
+                emitted = True
+                yield base_df, feature_df
+
+        if not emitted and all(buffer is not None for buffer in buffers):
+            yield buffers[0].iloc[:0], buffers[1].iloc[:0]
+
+    @staticmethod
+    def drop_null_columns(df):
+        # Drop the columns that have no values with one column mask
+        mask = df.notna().any().to_numpy()
+        if mask.all():
+            return df
+        return df.loc[:, mask]
+
+    @staticmethod
+    def prune_columns(base_df, feature_df, cols_to_ignore=[], drop_zero=False):
+        # Sorted columns common to both frames, without columns that contain any of cols_to_ignore and, optionally,
+        # columns that are all zero on both sides (drop_zero)
+        cols = base_df.columns.intersection(feature_df.columns)
+        if cols_to_ignore:
+            pattern = '|'.join(re.escape(col_to_ignore) for col_to_ignore in cols_to_ignore)
+            cols = cols[~np.asarray(cols.str.contains(pattern, regex=True), dtype=bool)]
+        if drop_zero:
+            cols = cols[~(base_df[cols].eq(0).all() & feature_df[cols].eq(0).all()).to_numpy()]
+        return sorted(cols)
+
+    @staticmethod
+    def diff(base_df, feature_df):
+        # Numeric columns get feature - base deltas; other columns get 1/0 mismatch flags (missing values never
+        # match). Columns present on only one side are NaN. Expects row-aligned frames (see align_rows).
+        cols = base_df.columns
+        if not cols.equals(feature_df.columns):
+            cols = pd.Index(sorted(set(cols) | set(feature_df.columns)))
+        common = [col for col in cols if col in base_df.columns and col in feature_df.columns]
+
+        def is_numeric(dtype):
+            return pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+
+        def is_integer(dtype):
+            return pd.api.types.is_integer_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+
+        ints = []
+        floats = []
+        others = []
+        for col in common:
+            base_dtype = base_df[col].dtype
+            feature_dtype = feature_df[col].dtype
+            if is_integer(base_dtype) and is_integer(feature_dtype):
+                ints.append(col)
+            elif is_numeric(base_dtype) and is_numeric(feature_dtype):
+                floats.append(col)
+            else:
+                others.append(col)
+
+        data = {}
+        if ints:
+            deltas = feature_df[ints].to_numpy(dtype=np.int64) - base_df[ints].to_numpy(dtype=np.int64)
+            data.update(zip(ints, deltas.T))
+        if floats:
+            deltas = feature_df[floats].to_numpy(dtype=np.float64) - base_df[floats].to_numpy(dtype=np.float64)
+            data.update(zip(floats, deltas.T))
+        if others:
+            base_values = base_df[others].to_numpy(dtype=object)
+            feature_values = feature_df[others].to_numpy(dtype=object)
+            mismatches = feature_values != base_values
+            # Equal values can still be missing on both sides (e.g., None == None)
+            matches = ~mismatches
+            mismatches[matches] = pd.isna(feature_values[matches])
+            data.update(zip(others, mismatches.astype(int).T))
+        for col in cols:
+            if col not in data:
+                data[col] = np.full(len(base_df), np.nan)
+
+        # Same column order as feature_df - base_df, or union_columns when a column isn't numeric
+        if others:
+            cols = pd.Index(sorted(cols))
+
+        return pd.DataFrame({col: data[col] for col in cols}, index=base_df.index)
+
+    @staticmethod
+    def columnar_file(csv_file):
+        basename, ext = os.path.splitext(csv_file)
+        return basename + '.parquet'
+
+    @classmethod
+    def has_columnar(cls, csv_file):
+        # A parquet sidecar is used in place of its csv when pyarrow is installed and the sidecar records the hash of
+        # the csv it was written with (see columnar_metadata); mtimes don't survive copies such as CI artifacts
+        columnar_file = cls.columnar_file(csv_file)
+        if not os.path.exists(columnar_file):
+            return False
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            return False
+        if not os.path.exists(csv_file):
+            return True
+
+        key = tuple((os.path.abspath(file), os.stat(file).st_size, os.stat(file).st_mtime_ns) for file in [csv_file, columnar_file])
+        if key not in columnar_checks:
+            metadata = pq.read_schema(columnar_file).metadata or {}
+            columnar_checks[key] = metadata.get(b'csv_sha1') == file_sha1(csv_file).encode()
+        return columnar_checks[key]
+
+    @staticmethod
+    def list_files(folder, excludes=[]):
+        # Columnar sidecars stand in for their csv, so only the csv files are listed; hidden files (e.g., the .map.json
+        # stamps of mapped results) are skipped
+        files = []
+        for file in os.listdir(folder):
+            if file not in excludes and not file.endswith('.parquet') and not file.startswith('.'):
+                files.append(file)
+        return files
+
+    @classmethod
+    def read_columns(cls, csv_file):
+        if cls.has_columnar(csv_file):
+            import pyarrow.parquet as pq
+            schema = pq.read_schema(cls.columnar_file(csv_file))
+            index_columns = schema.pandas_metadata.get('index_columns', []) if schema.pandas_metadata else []
+            return [col for col in schema.names if col not in index_columns]
+        return list(read_csv(csv_file, index_col=0, nrows=0).columns)
+
+    @classmethod
+    def read_results(cls, csv_file, columns=None):
+        # Read a results file indexed on its first column, preferring its columnar sidecar and only reading columns;
+        # csv files are read with the dtypes of cls.dtype_map (e.g., from dictionary_dtype_map) when one is set
+        if cls.has_columnar(csv_file):
+            return pd.read_parquet(cls.columnar_file(csv_file), columns=columns)
+        if columns is None:
+            return read_csv(csv_file, dtype_map=cls.dtype_map, index_col=0)
+        index_col = read_csv(csv_file, nrows=0).columns[0]
+        return read_csv(csv_file, dtype_map=cls.dtype_map, index_col=0, usecols=[index_col] + list(columns))
+
+    @classmethod
+    def chunk_dtypes(cls, csv_file, chunksize):
+        # The dtypes a full read of csv_file would infer, from one pass over its chunks: a column that is not numeric in
+        # every chunk is object, and an integer column with missing values in any chunk is float
+        if cls.has_columnar(csv_file):
+            return None
+
+        kinds = {}
+        for chunk in cls.iter_results(csv_file, chunksize):
+            for col, dtype in chunk.dtypes.items():
+                if pd.api.types.is_bool_dtype(dtype):
+                    kind = 'bool'
+                elif pd.api.types.is_integer_dtype(dtype):
+                    kind = 'int64'
+                elif pd.api.types.is_float_dtype(dtype):
+                    kind = 'float64'
+                else:
+                    kind = 'object'
+                kinds.setdefault(col, set()).add(kind)
+
+        dtypes = {}
+        for col, kind in kinds.items():
+            if len(kind) == 1:
+                dtypes[col] = kind.pop()
+            elif kind <= {'int64', 'float64'}:
+                dtypes[col] = 'float64'
+            else:
+                dtypes[col] = 'object'
+        return dtypes
+
+    @classmethod
+    def iter_results(cls, csv_file, chunksize, columns=None, dtype=None):
+        # Like read_results, one chunk of at most chunksize rows at a time; dtype (e.g., from chunk_dtypes) keeps the
+        # csv chunks consistent with each other
+        if cls.has_columnar(csv_file):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            parquet_file = pq.ParquetFile(cls.columnar_file(csv_file))
+            metadata = parquet_file.schema_arrow.pandas_metadata or {}
+            if columns is not None:
+                index_columns = [col for col in metadata.get('index_columns', []) if isinstance(col, str)]
+                columns = index_columns + list(columns)
+            for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+                table = pa.Table.from_batches([batch]).replace_schema_metadata(parquet_file.schema_arrow.metadata)
+                yield table.to_pandas()
+            return
+
+        if columns is None:
+            reader = read_csv(csv_file, index_col=0, chunksize=chunksize, dtype=dtype)
+        else:
+            index_col = read_csv(csv_file, nrows=0).columns[0]
+            reader = read_csv(csv_file, index_col=0, usecols=[index_col] + list(columns), chunksize=chunksize,
+                              dtype=dtype)
+        with reader:
+            for chunk in reader:
+                yield chunk
+
+    def load_results(self, csv_file, columns=None):
+        # Like read_results, but with a cache each file is read once in full and then subset per call
+        if self.cache is None:
+            return self.read_results(csv_file, columns=columns)
+        key = os.path.abspath(csv_file)
+        if key not in self.cache:
+            self.cache[key] = self.read_results(csv_file)
+        df = self.cache[key]
+        if columns is None:
+            return df.copy()
+        return df[list(columns)]
+
     def results(self, aggregate_column=None, aggregate_function=None, excludes=[], enum_maps={}):
         aggregate_columns = []
         if aggregate_column:
             aggregate_columns.append(aggregate_column)
 
-        files = []
-        for file in os.listdir(self.base_folder):
-            if file not in excludes:
-                files.append(file)
+        files = self.list_files(self.base_folder, excludes)
 
         for file in sorted(files):
             base_file = os.path.join(self.base_folder, file)
@@ -45,24 +310,16 @@ class BaseCompare:
                 print("Warning: %s not found. Skipping..." % feature_file)
                 continue
 
-            base_df = read_csv(base_file, index_col=0)
-            feature_df = read_csv(feature_file, index_col=0)
+            base_df = self.read_results(base_file)
+            feature_df = self.read_results(feature_file)
 
-            base_df = self.intersect_rows(base_df, feature_df)
-            feature_df = self.intersect_rows(feature_df, base_df)
+            base_df, feature_df = self.align_rows(base_df, feature_df)
 
             if file == 'results_output.csv':
                 base_df = base_df.select_dtypes(exclude=['string', 'bool'])
                 feature_df = feature_df.select_dtypes(exclude=['string', 'bool'])
 
-            try:
-                df = feature_df - base_df
-            except BaseException:
-                base_df = self.union_columns(base_df, feature_df)
-                feature_df = self.union_columns(feature_df, base_df)
-                df = feature_df != base_df
-                df = df.astype(int)
-
+            df = self.diff(base_df, feature_df)
             df = df.fillna('NA')
             df.to_csv(os.path.join(self.export_folder, file))
 
@@ -101,6 +358,118 @@ class BaseCompare:
         if not aggregate_function:
             return
 
+        basename, ext = os.path.splitext(file)
+        if aggregate_columns:
+            basename += '_{aggregate_column}'.format(aggregate_column=aggregate_columns[0])
+
+        self.write_deltas(base_df, feature_df, sim_ct_base, sim_ct_feature, aggregate_columns)
+
+    def results_chunked(self, aggregate_column=None, aggregate_function=None, excludes=[], enum_maps={},
+                        chunksize=100000):
+        # Out-of-core results: streams index-sorted base and feature files in aligned chunks (see align_chunks), appending
+        # each chunk's diff and folding per-group sums and counts, so memory is bounded by chunksize rather than the
+        # number of buildings. Writes the same files as results.
+        aggregate_columns = []
+        if aggregate_column:
+            aggregate_columns.append(aggregate_column)
+
+        def group_lookup():
+            # Aggregate column values of the characteristics rows common to base and feature, looked up for ascending
+            # chunks of the results_output index; rows before the requested keys are dropped as the stream advances
+            characteristics_file = 'results_characteristics.csv'
+            chunks = self.align_chunks(self.iter_results(os.path.join(self.base_folder, characteristics_file), chunksize,
+                                                         aggregate_columns),
+                                       self.iter_results(os.path.join(self.feature_folder, characteristics_file), chunksize,
+                                                         aggregate_columns))
+            state = {'buffer': pd.DataFrame(columns=aggregate_columns), 'done': False}
+
+            def lookup(index):
+                while not state['done'] and len(index) and \
+                        (state['buffer'].empty or state['buffer'].index[-1] < index[-1]):
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        state['done'] = True
+                    else:
+                        state['buffer'] = pd.concat([state['buffer'], chunk[0]]) if not state['buffer'].empty else chunk[0]
+                if len(index):
+                    buffer = state['buffer']
+                    state['buffer'] = buffer.iloc[buffer.index.searchsorted(index[0], side='left'):]
+                group_df = state['buffer'].reindex(index)
+                for col, enum_map in enum_maps.items():
+                    if col in aggregate_columns:
+                        group_df[col] = group_df[col].map(enum_map)
+                return group_df
+
+            return lookup
+
+        files = self.list_files(self.base_folder, excludes)
+
+        for file in sorted(files):
+            base_file = os.path.join(self.base_folder, file)
+            feature_file = os.path.join(self.feature_folder, file)
+
+            if not os.path.exists(feature_file):
+                print("Warning: %s not found. Skipping..." % feature_file)
+                continue
+
+            aggregate = file == 'results_output.csv' and aggregate_function
+            if aggregate and aggregate_columns:
+                lookup = group_lookup()
+
+            header = None
+            sim_ct = 0
+            sums = None
+            counts = None
+            base_chunks = self.iter_results(base_file, chunksize, dtype=self.chunk_dtypes(base_file, chunksize))
+            feature_chunks = self.iter_results(feature_file, chunksize, dtype=self.chunk_dtypes(feature_file, chunksize))
+            for base_df, feature_df in self.align_chunks(base_chunks, feature_chunks):
+                if file == 'results_output.csv':
+                    base_df = base_df.select_dtypes(exclude=['string', 'bool'])
+                    feature_df = feature_df.select_dtypes(exclude=['string', 'bool'])
+
+                df = self.diff(base_df, feature_df)
+                df = df.fillna('NA')
+                if header is None:
+                    header = df.columns
+                    df.to_csv(os.path.join(self.export_folder, file))
+                else:
+                    df.reindex(columns=header).to_csv(os.path.join(self.export_folder, file), mode='a', header=False)
+
+                if not aggregate:
+                    continue
+
+                # Fold per-group sums and counts of the non-missing numeric values
+                sim_ct += len(base_df)
+                parts = []
+                for df in [base_df, feature_df]:
+                    df = df.select_dtypes(include='number')
+                    if aggregate_columns:
+                        keys = [lookup(df.index)[col] for col in aggregate_columns]
+                        parts.append((df.groupby(keys).sum(), df.notna().groupby(keys).sum()))
+                    else:
+                        parts.append((df.sum().to_frame().transpose(), df.notna().sum().to_frame().transpose()))
+                if sums is None:
+                    sums = [part[0] for part in parts]
+                    counts = [part[1] for part in parts]
+                else:
+                    sums = [total.add(part[0], fill_value=0) for total, part in zip(sums, parts)]
+                    counts = [total.add(part[1], fill_value=0) for total, part in zip(counts, parts)]
+
+            if aggregate and sums is not None:
+                results = []
+                for total, count in zip(sums, counts):
+                    if aggregate_function == 'sum':
+                        df = total.where(count > 0)
+                    elif aggregate_function == 'mean':
+                        df = total / count.where(count > 0)
+                    if aggregate_columns:
+                        df.index.names = aggregate_columns
+                        results.append(df.stack(dropna=False))
+                    else:
+                        results.append(df.iloc[0])
+                self.write_deltas(results[0], results[1], sim_ct, sim_ct, aggregate_columns)
+
+    def write_deltas(self, base_df, feature_df, sim_ct_base, sim_ct_feature, aggregate_columns):
         # Write aggregate results df
         deltas = pd.DataFrame()
         deltas['base'] = base_df
@@ -124,18 +493,111 @@ class BaseCompare:
             first_col = deltas.pop(group)
             deltas.insert(0, group, first_col)
 
-        basename, ext = os.path.splitext(file)
-        if aggregate_columns:
-            basename += '_{aggregate_column}'.format(aggregate_column=aggregate_columns[0])
-
         deltas.to_csv(
             os.path.join(
                 self.export_folder,
                 self.export_file))
 
+    def gate(self, tolerances=[], top_k=None, excludes=[]):
+        # Pass/fail check of feature against base results that only writes a summary of the failing columns. A numeric
+        # value fails when |feature - base| > abs + rel * |base|, with (abs, rel) from the first (pattern, abs, rel)
+        # in tolerances whose pattern matches the column (exact match otherwise); other values fail when they differ.
+        # Rows missing on either side fail too. Stops at the first file with a failure unless top_k is given, in which
+        # case the top_k columns with the most failures are kept.
+        patterns = [(re.compile(pattern), abs_tol, rel_tol) for pattern, abs_tol, rel_tol in tolerances]
+
+        def tolerance(col):
+            for pattern, abs_tol, rel_tol in patterns:
+                if pattern.search(col):
+                    return abs_tol, rel_tol
+            return 0.0, 0.0
+
+        def is_numeric(dtype):
+            return pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+
+        failures = []
+
+        def add_failure(file, col, reason, n_failures, n_rows, max_abs_diff=np.nan, row=None, base=None, feature=None):
+            failures.append({'file': file, 'column': col, 'reason': reason, 'failures': n_failures, 'rows': n_rows,
+                             'max_abs_diff': max_abs_diff, 'worst_row': row, 'base': base, 'feature': feature})
+
+        files = self.list_files(self.base_folder, excludes)
+
+        for file in sorted(files):
+            if failures and top_k is None:
+                break
+
+            base_file = os.path.join(self.base_folder, file)
+            feature_file = os.path.join(self.feature_folder, file)
+
+            if not os.path.exists(feature_file):
+                add_failure(file, None, 'missing file', 1, 0)
+                continue
+
+            base_df = self.read_results(base_file)
+            feature_df = self.read_results(feature_file)
+
+            # Rows (e.g., buildings) on only one side fail before the rest are compared on the rows both have
+            for reason, missing, n_total in [('missing rows in feature', base_df.index.difference(feature_df.index), len(base_df)),
+                                             ('missing rows in base', feature_df.index.difference(base_df.index), len(feature_df))]:
+                if len(missing):
+                    add_failure(file, None, reason, len(missing), n_total, row=missing[0])
+
+            base_df, feature_df = self.align_rows(base_df, feature_df)
+            n_rows = len(base_df)
+
+            for col in base_df.columns.difference(feature_df.columns):
+                add_failure(file, col, 'missing in feature', n_rows, n_rows)
+            for col in feature_df.columns.difference(base_df.columns):
+                add_failure(file, col, 'missing in base', n_rows, n_rows)
+
+            common = base_df.columns.intersection(feature_df.columns)
+            numeric = [col for col in common if is_numeric(base_df[col].dtype) and is_numeric(feature_df[col].dtype)]
+            others = [col for col in common if col not in set(numeric)]
+
+            if numeric:
+                b = base_df[numeric].to_numpy(dtype=np.float64)
+                f = feature_df[numeric].to_numpy(dtype=np.float64)
+                abs_tols, rel_tols = np.array([tolerance(col) for col in numeric], dtype=np.float64).reshape(-1, 2).T
+                deltas = np.abs(f - b)
+                failed = (deltas > abs_tols + rel_tols * np.abs(b)) | (np.isnan(b) != np.isnan(f))
+                for j in np.flatnonzero(failed.any(axis=0)):
+                    i = np.flatnonzero(failed[:, j])[np.argmax(np.nan_to_num(deltas[failed[:, j], j], nan=np.inf))]
+                    add_failure(file, numeric[j], 'tolerance', int(failed[:, j].sum()), n_rows,
+                                np.nan_to_num(deltas[i, j], nan=np.inf), base_df.index[i], b[i, j], f[i, j])
+
+            if others:
+                b = base_df[others].to_numpy(dtype=object)
+                f = feature_df[others].to_numpy(dtype=object)
+                failed = (b != f) & ~(pd.isna(b) & pd.isna(f))
+                for j in np.flatnonzero(failed.any(axis=0)):
+                    i = np.argmax(failed[:, j])
+                    add_failure(file, others[j], 'mismatch', int(failed[:, j].sum()), n_rows,
+                                row=base_df.index[i], base=b[i, j], feature=f[i, j])
+
+        columns = ['file', 'column', 'reason', 'failures', 'rows', 'max_abs_diff', 'worst_row', 'base', 'feature']
+        df = pd.DataFrame(failures, columns=columns)
+        df = df.sort_values(['failures', 'max_abs_diff'], ascending=False, kind='stable')
+        if top_k is not None:
+            df = df.head(top_k)
+
+        export_file = self.export_file if self.export_file else 'gate.csv'
+        df.to_csv(os.path.join(self.export_folder, export_file), index=False)
+
+        if df.empty:
+            print('Gate passed: {} files within tolerance'.format(len(files)))
+        else:
+            print('Gate failed: {} columns out of tolerance'.format(len(failures)))
+            print(df.to_string(index=False))
+        return df
+
     def visualize(self, aggregate_column=None, aggregate_function=None, display_column=None,
-                  excludes=[], enum_maps={}, cols_to_ignore=[]):
+                  excludes=[], enum_maps={}, cols_to_ignore=[], webgl=False, max_points=None, include_plotlyjs=True,
+                  files=None):
+        # For large N: webgl renders markers with Scattergl, max_points decimates each subplot (see decimate), and
+        # include_plotlyjs='directory' references one plotly.min.js in the export folder instead of embedding it
         colors = px.colors.qualitative.Dark24
+        scatter = go.Scattergl if webgl else go.Scatter
 
         aggregate_columns = []
         if aggregate_column:
@@ -145,26 +607,22 @@ class BaseCompare:
         if display_column:
             display_columns.append(display_column)
 
-        files = []
-        for file in os.listdir(self.base_folder):
-            if file not in excludes:
-                files.append(file)
+        if files is None:
+            files = self.list_files(self.base_folder, excludes)
 
         if display_columns or aggregate_columns:
-            base_characteristics_df = read_csv(
+            base_characteristics_df = self.load_results(
                 os.path.join(
                     self.base_folder,
                     'results_characteristics.csv'),
-                index_col=0)[
-                display_columns +
-                aggregate_columns]
-            feature_characteristics_df = read_csv(
+                columns=display_columns +
+                aggregate_columns)
+            feature_characteristics_df = self.load_results(
                 os.path.join(
                     self.feature_folder,
                     'results_characteristics.csv'),
-                index_col=0)[
-                display_columns +
-                aggregate_columns]
+                columns=display_columns +
+                aggregate_columns)
 
         def get_min_max(x_col, y_col, min_value, max_value):
             try:
@@ -191,15 +649,20 @@ class BaseCompare:
                                      line=dict(color='black', dash='dashdot', width=1), mode='lines',
                                      showlegend=False), row=row, col=col)
 
-        def remove_columns(cols):
-            for col in cols[:]:
-                if all(v == 0 for v in base_df[col].values) and all(v == 0 for v in feature_df[col].values):
-                    cols.remove(col)
-            for col in cols[:]:
-                for col_to_ignore in cols_to_ignore:
-                    if col_to_ignore in col:
-                        cols.remove(col)
-            return cols
+        def decimate(x_col, y_col):
+            # Keep every point outside the +/- 10% error lines and an evenly spaced sample of the rest
+            keep = np.ones(len(x_col), dtype=bool)
+            if not max_points or len(x_col) <= max_points:
+                return keep
+
+            x_values = pd.to_numeric(x_col, errors='coerce').to_numpy(dtype=float)
+            y_values = pd.to_numeric(y_col, errors='coerce').to_numpy(dtype=float)
+            keep = np.abs(y_values - x_values) > 0.1 * np.abs(x_values)
+            inside = np.flatnonzero(~keep & np.isfinite(x_values) & np.isfinite(y_values))
+            n_sample = min(max(max_points - keep.sum(), 0), len(inside))
+            if n_sample > 0:
+                keep[inside[np.linspace(0, len(inside) - 1, n_sample).astype(int)]] = True
+            return keep
 
         for file in sorted(files):
             base_file = os.path.join(self.base_folder, file)
@@ -209,21 +672,21 @@ class BaseCompare:
                 print("Warning: %s not found. Skipping..." % feature_file)
                 continue
 
-            base_df = read_csv(base_file, index_col=0)
-            feature_df = read_csv(feature_file, index_col=0)
+            # Only read the columns that can be plotted; color_index is kept for coloring the markers
+            def plotted_columns(csv_file):
+                return [col for col in self.read_columns(csv_file)
+                        if col == 'color_index' or not any(col_to_ignore in col for col_to_ignore in cols_to_ignore)]
+
+            base_df = self.load_results(base_file, columns=plotted_columns(base_file))
+            feature_df = self.load_results(feature_file, columns=plotted_columns(feature_file))
 
             base_df = self.intersect_rows(base_df, feature_df)
             feature_df = self.intersect_rows(feature_df, base_df)
 
-            for col in base_df.columns:
-                if base_df[col].isnull().all():
-                    base_df.drop(col, axis=1, inplace=True)
-            for col in feature_df.columns:
-                if feature_df[col].isnull().all():
-                    feature_df.drop(col, axis=1, inplace=True)
+            base_df = self.drop_null_columns(base_df)
+            feature_df = self.drop_null_columns(feature_df)
 
-            cols = sorted(list(set(base_df.columns) & set(feature_df.columns)))
-            cols = remove_columns(cols)
+            cols = self.prune_columns(base_df, feature_df, cols_to_ignore, drop_zero=True)
             n_cols = max(len(cols), 1)
 
             groups = [None]
@@ -248,63 +711,73 @@ class BaseCompare:
                     f'<b>{f}</b>' for f in cols],
                 vertical_spacing=vertical_spacing)
 
+            # Split and aggregate each display group once per file; the loop over columns below only selects columns
+            panels = []
+            for group in groups:
+                x = base_df
+                y = feature_df
+
+                if group:
+                    x = x.loc[x[display_columns[0]] == group, :]
+                    y = y.loc[y[display_columns[0]] == group, :]
+
+                splits = []
+                color = [colors[0]] * len(y)
+                if aggregate_function:
+                    x = x.assign(count=1)
+                    sizes = x.groupby(aggregate_columns)[['count']].sum().reset_index()
+
+                    if aggregate_function == 'sum':
+                        x = x.groupby(aggregate_columns).sum().reset_index()
+                        y = y.groupby(aggregate_columns).sum().reset_index()
+                    elif aggregate_function == 'mean':
+                        x = x.groupby(aggregate_columns).mean().reset_index()
+                        y = y.groupby(aggregate_columns).mean().reset_index()
+
+                    for agg_col in sorted(list(x[aggregate_columns[0]].unique())):
+                        x_c = x[x[aggregate_columns[0]] == agg_col]
+                        y_c = y[y[aggregate_columns[0]] == agg_col]
+                        s_c = sizes[sizes[aggregate_columns[0]] == agg_col]
+                        splits.append((agg_col, x_c, y_c, s_c))
+                elif 'color_index' in y.columns.values:
+                    color = [colors[i] for i in y['color_index']]
+
+                panels.append((x, y, splits, color))
+
             nrow = 0
             for col in cols:
                 nrow += 1
-                for group in groups:
-                    ncol = groups.index(group) + 1
+                for ncol, (x, y, splits, color) in enumerate(panels, start=1):
                     showlegend = False
                     if ncol == 1 and nrow == 1:
                         showlegend = True
 
-                    x = base_df.copy()
-                    y = feature_df.copy()
-
-                    if group:
-                        x = x.loc[x[display_columns[0]] == group, :]
-                        y = y.loc[y[display_columns[0]] == group, :]
-
                     if aggregate_function:
-                        x = x.assign(count=1)
-                        sizes = x.groupby(aggregate_columns)[['count']].sum().reset_index()
-
-                        if aggregate_function == 'sum':
-                            x = x.groupby(aggregate_columns).sum().reset_index()
-                            y = y.groupby(aggregate_columns).sum().reset_index()
-                        elif aggregate_function == 'mean':
-                            x = x.groupby(aggregate_columns).mean().reset_index()
-                            y = y.groupby(aggregate_columns).mean().reset_index()
-
-                        for agg_col in sorted(list(x[aggregate_columns[0]].unique())):
-                            x_c = x[x[aggregate_columns[0]] == agg_col]
-                            y_c = y[y[aggregate_columns[0]] == agg_col]
-                            s_c = sizes[sizes[aggregate_columns[0]] == agg_col]
-                            fig.add_trace(go.Scatter(x=x_c[col],
-                                                     y=y_c[col],
-                                                     marker=dict(size=s_c['count'],
-                                                                 line=dict(width=1.5,
-                                                                           color='DarkSlateGrey')),
-                                                     mode='markers',
-                                                     text=s_c['count'],
-                                                     name=agg_col,
-                                                     legendgroup=agg_col,
-                                                     showlegend=False),
+                        for agg_col, x_c, y_c, s_c in splits:
+                            fig.add_trace(scatter(x=x_c[col],
+                                                  y=y_c[col],
+                                                  marker=dict(size=s_c['count'],
+                                                              line=dict(width=1.5,
+                                                                        color='DarkSlateGrey')),
+                                                  mode='markers',
+                                                  text=s_c['count'],
+                                                  name=agg_col,
+                                                  legendgroup=agg_col,
+                                                  showlegend=False),
                                           row=nrow, col=ncol)
                     else:
-                        color = [colors[0] for i in y[col]]
-                        if 'color_index' in y.columns.values:
-                            color = [colors[i] for i in y['color_index']]
-                        fig.add_trace(go.Scatter(x=x[col],
-                                                 y=y[col],
-                                                 marker=dict(size=12,
-                                                             color=color,
-                                                             line=dict(width=1.5,
-                                                                       color='DarkSlateGrey')),
-                                                 mode='markers',
-                                                 text=x.index,
-                                                 name='',
-                                                 legendgroup=col,
-                                                 showlegend=False),
+                        keep = decimate(x[col], y[col])
+                        fig.add_trace(scatter(x=x[col][keep],
+                                              y=y[col][keep],
+                                              marker=dict(size=12,
+                                                          color=[c for c, k in zip(color, keep) if k],
+                                                          line=dict(width=1.5,
+                                                                    color='DarkSlateGrey')),
+                                              mode='markers',
+                                              text=x.index[keep],
+                                              name='',
+                                              legendgroup=col,
+                                              showlegend=False),
                                       row=nrow, col=ncol)
 
                     min_value, max_value = get_min_max(x[col], y[col], 0, 0)
@@ -331,12 +804,106 @@ class BaseCompare:
 
             plotly.offline.plot(fig,
                                 filename=os.path.join(self.export_folder, '{filename}'.format(filename=filename)),
+                                include_plotlyjs=include_plotlyjs,
                                 auto_open=False)
 
 
-def read_csv(csv_file_path, **kwargs) -> pd.DataFrame:
+worker_compare = None
+
+
+def init_worker(compare):
+    global worker_compare
+    worker_compare = compare
+
+
+def visualize_worker(export_file, kwargs):
+    worker_compare.export_file = export_file
+    worker_compare.visualize(**kwargs)
+
+
+def visualize_parallel(compare, tasks, jobs):
+    # Render each (export_file, visualize kwargs) task in a worker process. Frames in compare.cache are loaded here
+    # first, so forked workers share them read-only instead of each re-reading the files.
+    if compare.cache is not None:
+        for folder in [compare.base_folder, compare.feature_folder]:
+            for file in compare.list_files(folder):
+                compare.load_results(os.path.join(folder, file))
+
+    mp_context = None
+    if 'fork' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('fork')
+
+    with ProcessPoolExecutor(jobs, mp_context=mp_context, initializer=init_worker, initargs=(compare,)) as executor:
+        futures = [executor.submit(visualize_worker, export_file, kwargs) for export_file, kwargs in tasks]
+        for future in futures:
+            future.result()
+
+
+# has_columnar results by the size and mtime of the csv and its sidecar
+columnar_checks = {}
+
+
+def file_sha1(file):
+    sha = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def columnar_metadata(csv_file) -> dict:
+    # Schema metadata for the parquet sidecar of csv_file, tying the sidecar to the csv contents
+    return {b'csv_sha1': file_sha1(csv_file).encode()}
+
+
+def read_tolerances(tolerance_file):
+    # Rows of pattern, abs, rel; patterns are regular expressions searched in the column names, first match wins
+    df = pd.read_csv(tolerance_file, dtype={'pattern': str}, keep_default_na=False)
+    return [(pattern, float(abs_tol), float(rel_tol)) for pattern, abs_tol, rel_tol in zip(df['pattern'], df['abs'], df['rel'])]
+
+
+def dictionary_dtype_map(dictionary_folder, energy_units=['MBtu', 'kBtu', 'kWh', 'therm']) -> dict:
+    # Map data dictionary columns to compact dtypes: categoricals for housing characteristics (inputs documented
+    # with a :ref: to their characteristic) and float32 for energy outputs (annual and timeseries names)
+    dtype_map = {}
+
+    inputs = pd.read_csv(os.path.join(dictionary_folder, 'inputs.csv'))
+    for name, description in zip(inputs['Input Name'], inputs['Input Description']):
+        if str(description).startswith(':ref:'):
+            dtype_map[name] = 'category'
+
+    outputs = pd.read_csv(os.path.join(dictionary_folder, 'outputs.csv'))
+    for name_col, units_col in [('Annual Name', 'Annual Units'),
+                                ('Timeseries ResStock Name', 'Timeseries Units'),
+                                ('Timeseries BuildStockBatch Name', 'Timeseries Units')]:
+        for name, units in zip(outputs[name_col], outputs[units_col]):
+            if isinstance(name, str) and units in energy_units:
+                dtype_map[name] = 'float32'
+
+    return dtype_map
+
+
+def read_csv(csv_file_path, dtype_map=None, **kwargs) -> pd.DataFrame:
     default_na_values = pd._libs.parsers.STR_NA_VALUES
-    df = pd.read_csv(csv_file_path, na_values=list(default_na_values - {'None'}), keep_default_na=False, **kwargs)
+    na_values = list(default_na_values - {'None'})
+    if dtype_map is None:
+        df = pd.read_csv(csv_file_path, na_values=na_values, keep_default_na=False, **kwargs)
+        return df
+
+    # Typed mode: apply the dtypes of the columns present in the header and parse with pyarrow when the
+    # requested options allow it (the pyarrow engine does not support list skiprows, for example)
+    header = pd.read_csv(csv_file_path, nrows=0, **{k: v for k, v in kwargs.items() if k in ['sep', 'usecols']})
+    dtype = {col: dtype_map[col] for col in header.columns if col in dtype_map}
+    dtype.update(kwargs.pop('dtype', {}))
+    engine = 'pyarrow'
+    if not set(kwargs).issubset({'index_col', 'usecols', 'sep', 'header', 'names'}):
+        engine = 'c'
+    df = pd.read_csv(csv_file_path, na_values=na_values, keep_default_na=False, dtype=dtype, engine=engine, **kwargs)
+
+    # The pyarrow engine leaves missing strings as None; use NaN like the default mode
+    object_cols = df.columns[df.dtypes == object]
+    if len(object_cols):
+        df[object_cols] = df[object_cols].where(df[object_cols].notna(), np.nan)
     return df
 
 
@@ -345,7 +912,7 @@ if __name__ == '__main__':
     default_base_folder = 'workflow/tests/base_results'
     default_feature_folder = 'workflow/tests/test_results'
     default_export_folder = 'workflow/tests/comparisons'
-    actions = [method for method in dir(BaseCompare) if method.startswith('__') is False]
+    actions = ['results', 'gate', 'visualize']
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-b', '--base_folder', default=default_base_folder, help='Path of the base folder.')
@@ -353,6 +920,12 @@ if __name__ == '__main__':
     parser.add_argument('-e', '--export_folder', default=default_export_folder, help='Path of the export folder.')
     parser.add_argument('-x', '--export_file', help='Path of the export file.')
     parser.add_argument('-a', '--actions', action='append', choices=actions, help='Method to call.')
+    parser.add_argument('-gl', '--webgl', action='store_true', help='Render large comparison plots with WebGL and one shared plotly.min.js.')
+    parser.add_argument('-mp', '--max_points', type=int, help='Maximum number of points per subplot; points outside the +/- 10%% error lines are always kept.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes for rendering figures.')
+    parser.add_argument('-t', '--tolerance_file', help='Tolerances csv (pattern, abs, rel) for the gate action; values must match exactly otherwise.')
+    parser.add_argument('-k', '--top_k', type=int, help='Collect the k worst failing columns for the gate action instead of stopping at the first.')
+    parser.add_argument('-cs', '--chunksize', type=int, help='Compare results in chunks of this many rows; files must be sorted by their index.')
     args = parser.parse_args()
     print(args)
 
@@ -366,6 +939,28 @@ if __name__ == '__main__':
 
     for action in args.actions:
         if action == 'results':
-            compare.results()
+            if args.chunksize:
+                compare.results_chunked(chunksize=args.chunksize)
+            else:
+                compare.results()
+        elif action == 'gate':
+            tolerances = read_tolerances(args.tolerance_file) if args.tolerance_file else []
+            if not compare.gate(tolerances, args.top_k).empty:
+                sys.exit(1)
         elif action == 'visualize':
-            compare.visualize()
+            include_plotlyjs = 'directory' if args.webgl else True
+            kwargs = {'webgl': args.webgl, 'max_points': args.max_points, 'include_plotlyjs': include_plotlyjs}
+            if args.jobs > 1:
+                # One figure per results file; with several files each gets its own export file, e.g., figures.html
+                # -> figures_results_output.html, instead of every worker writing the same file
+                files = compare.list_files(args.base_folder)
+                tasks = []
+                for file in files:
+                    export_file = args.export_file
+                    if export_file and len(files) > 1:
+                        export_file, ext = os.path.splitext(export_file)
+                        export_file = '{}_{}{}'.format(export_file, os.path.splitext(file)[0], ext)
+                    tasks.append((export_file, dict(kwargs, files=[file])))
+                visualize_parallel(compare, tasks, args.jobs)
+            else:
+                compare.visualize(**kwargs)
@@ -0,0 +1,75 @@
+"""
+Time BaseCompare.align_rows + BaseCompare.diff against the previous intersect_rows + (feature - base, falling back to
+union_columns + elementwise !=) approach on synthetic results files with numeric and string columns.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.abspath(__file__), '../../resources/hpxml-measures/workflow/tests')))
+from compare import BaseCompare
+
+
+def synthetic_results(n_buildings, n_floats, n_ints, n_strings, seed):
+  rng = np.random.default_rng(seed)
+  index = pd.Index(['project_national-{}.osw'.format('%07d' % i) for i in range(n_buildings)], name='OSW')
+  data = {}
+  for i in range(n_floats):
+    data['report_simulation_output.float_{}'.format(i)] = rng.random(n_buildings) * 100
+  for i in range(n_ints):
+    data['report_simulation_output.int_{}'.format(i)] = rng.integers(0, 10, n_buildings)
+  for i in range(n_strings):
+    data['build_existing_model.string_{}'.format(i)] = rng.choice(['Option A', 'Option B', 'None'], n_buildings).astype(object)
+  return pd.DataFrame(data, index=index)
+
+
+def legacy_diff(base_df, feature_df):
+  base_df = BaseCompare.intersect_rows(base_df, feature_df)
+  feature_df = BaseCompare.intersect_rows(feature_df, base_df)
+  try:
+    df = feature_df - base_df
+  except BaseException:
+    base_df = BaseCompare.union_columns(base_df, feature_df)
+    feature_df = BaseCompare.union_columns(feature_df, base_df)
+    df = feature_df != base_df
+    df = df.astype(int)
+  return df
+
+
+def aligned_diff(base_df, feature_df):
+  base_df, feature_df = BaseCompare.align_rows(base_df, feature_df)
+  return BaseCompare.diff(base_df, feature_df)
+
+
+def best_of(func, repeat, *args):
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    func(*args)
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-n', '--n_buildings', type=int, nargs='+', default=[10000, 100000, 1000000], help='Numbers of buildings to time.')
+  parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of repetitions; the best time is reported.')
+  args = parser.parse_args()
+
+  rows = []
+  for n_buildings in args.n_buildings:
+    base_df = synthetic_results(n_buildings, 20, 5, 5, 0)
+    feature_df = synthetic_results(n_buildings, 20, 5, 5, 1)
+    # Drop 1% of the feature buildings so rows have to be aligned
+    feature_df = feature_df.iloc[n_buildings // 100:]
+
+    for name, func in [('legacy', legacy_diff), ('aligned', aligned_diff)]:
+      rows.append({'buildings': n_buildings, 'method': name, 'seconds': best_of(func, args.repeat, base_df, feature_df)})
+
+  df = pd.DataFrame(rows).pivot(index='buildings', columns='method', values='seconds')
+  df['speedup'] = df['legacy'] / df['aligned']
+  print(df.round(3))
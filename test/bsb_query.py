@@ -0,0 +1,145 @@
+import os
+import sys
+import argparse
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+
+
+def accumulate(dfs):
+  # Fold frames into a running sum so only the total and the current frame are held in memory
+  total = None
+  for df in dfs:
+    if df is None:
+      continue
+    elif total is None:
+      total = df
+    else:
+      total = total.add(df, fill_value=0)
+
+  return total
+
+
+def aggregate_batches(batches, keys, columns):
+  # Sum and count the non-null values of each column by keys per record batch and fold the partials, so only one
+  # batch is in memory at a time; columns are ('sum', column) and ('count', column)
+  def aggregate(batch):
+    df = batch.to_pandas()
+    if df.empty:
+      return None
+    if not keys:
+      df = df[columns]
+      return pd.concat({'sum': df.sum().to_frame('all').transpose(), 'count': df.count().to_frame('all').transpose()}, axis=1)
+    grouped = df.groupby(keys)[columns]
+    return pd.concat({'sum': grouped.sum(), 'count': grouped.count()}, axis=1)
+
+  return accumulate(aggregate(batch) for batch in batches)
+
+
+def finalize(df, aggregate_function):
+  if df is None:
+    return None
+
+  if aggregate_function == 'mean':
+    return df['sum'] / df['count']
+  elif aggregate_function == 'sum':
+    return df['sum']
+  elif aggregate_function == 'count':
+    return df['count'].astype('int64')
+  return df
+
+
+def unified_schema(dataset):
+  # A dataset's schema is taken from its first file, so columns only in other files (e.g., end uses of an upgrade, or
+  # group files with different end uses) would be dropped; use the union of every file's schema instead
+  # Columns inferred as numbers in some files and as strings in others (e.g., occupants "10+") are read as strings
+  schemas = [dataset.schema] + [fragment.physical_schema for fragment in dataset.get_fragments()]
+  types = {}
+  for schema in schemas:
+    for field in schema:
+      types.setdefault(field.name, []).append(field.type)
+
+  fields = []
+  for name, field_types in types.items():
+    try:
+      fields.append(pa.unify_schemas([pa.schema([(name, field_type)]) for field_type in field_types], promote_options='permissive').field(name))
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+      fields.append(pa.field(name, pa.string()))
+  return pa.schema(fields)
+
+
+class BSBQuery:
+  # Out-of-core group-by aggregations over a buildstockbatch output directory, i.e., results_csvs/results_upXX.csv
+  # and the hive-partitioned parquet/timeseries/upgrade=N files. Files are streamed one record batch at a time.
+  def __init__(self, output_dir):
+    self.output_dir = output_dir
+
+  def results_dataset(self, upgrades=None):
+    results_csvs = os.path.join(self.output_dir, 'results_csvs')
+    files = []
+    for file in sorted(os.listdir(results_csvs)):
+      if not file.startswith('results_up'):
+        continue
+      upgrade = int(file[len('results_up'):].split('.')[0])
+      if upgrades is None or upgrade in upgrades:
+        files.append(os.path.join(results_csvs, file))
+
+    # Same NA handling as read_csv: "None" is a valid option, not a missing value
+    null_values = sorted(pd._libs.parsers.STR_NA_VALUES - {'None'})
+    convert_options = pacsv.ConvertOptions(null_values=null_values, strings_can_be_null=True)
+    file_format = ds.CsvFileFormat(convert_options=convert_options)
+    schema = unified_schema(ds.dataset(files, format=file_format))
+    return ds.dataset(files, schema=schema, format=file_format)
+
+  def timeseries_dataset(self):
+    path = os.path.join(self.output_dir, 'parquet', 'timeseries')
+    schema = unified_schema(ds.dataset(path, format='parquet', partitioning='hive'))
+    return ds.dataset(path, schema=schema, format='parquet', partitioning='hive')
+
+  def annual(self, columns, group_by=[], upgrades=None, aggregate_function='sum'):
+    # e.g., annual end use by build_existing_model.census_region
+    dataset = self.results_dataset(upgrades)
+    batches = dataset.to_batches(columns=list(group_by) + list(columns))
+    return finalize(aggregate_batches(batches, list(group_by), list(columns)), aggregate_function)
+
+  def timeseries(self, columns=None, group_by=['time'], upgrades=None, aggregate_function='sum'):
+    # e.g., hourly totals by upgrade with group_by=['upgrade', 'time']
+    dataset = self.timeseries_dataset()
+    if columns is None:
+      skips = set(['building_id', 'upgrade', 'time', 'timedst', 'timeutc'])
+      columns = [col for col in dataset.schema.names if col not in skips and not col.startswith('__index_level_')]
+
+    filter = None
+    if upgrades is not None:
+      filter = ds.field('upgrade').isin(list(upgrades))
+
+    batches = dataset.to_batches(columns=list(group_by) + list(columns), filter=filter)
+    return finalize(aggregate_batches(batches, list(group_by), list(columns)), aggregate_function)
+
+
+if __name__ == '__main__':
+
+  actions = ['annual', 'timeseries']
+  aggregate_functions = ['sum', 'mean', 'count']
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-o', '--output_dir', required=True, help='The buildstockbatch output directory.')
+  parser.add_argument('-a', '--action', choices=actions, required=True, help='Which results to aggregate.')
+  parser.add_argument('-c', '--columns', nargs='+', help='The columns to aggregate; defaults to all timeseries columns.')
+  parser.add_argument('-g', '--group_by', nargs='+', default=[], help='The columns to group by.')
+  parser.add_argument('-u', '--upgrades', type=int, nargs='+', help='The upgrades to include; defaults to all.')
+  parser.add_argument('-af', '--aggregate_function', choices=aggregate_functions, default='sum', help='Function to use for aggregating data.')
+  parser.add_argument('-x', '--export_file', required=True, help='The path of the export file.')
+
+  args = parser.parse_args()
+
+  query = BSBQuery(args.output_dir)
+  if args.action == 'annual':
+    if not args.columns:
+      sys.exit('The annual action requires --columns.')
+    df = query.annual(args.columns, args.group_by, args.upgrades, args.aggregate_function)
+  elif args.action == 'timeseries':
+    df = query.timeseries(args.columns, args.group_by or ['time'], args.upgrades, args.aggregate_function)
+
+  df.to_csv(args.export_file)
@@ -1,6 +1,9 @@
 import os
 import sys
+import json
+import hashlib
 import argparse
+import functools
 import numpy as np
 import pandas as pd
 import csv
@@ -8,7 +11,7 @@ import plotly
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.abspath(__file__), '../../resources/hpxml-measures/workflow/tests')))
-from compare import BaseCompare, read_csv
+from compare import BaseCompare, dictionary_dtype_map, read_csv, read_tolerances, visualize_parallel
 
 
 enum_maps = {'build_existing_model.geometry_building_type_recs': {'Single-Family Detached': 'SFD',
@@ -17,7 +20,55 @@ enum_maps = {'build_existing_model.geometry_building_type_recs': {'Single-Family
                                                                   'Multi-Family with 2 - 4 Units': 'MF',
                                                                   'Multi-Family with 5+ Units': 'MF'} }
 
+
+def dictionary_units(dictionary_folder):
+  # Map every output in the data dictionary (annual and timeseries names) to its units, e.g., MBtu, kWh or lb
+  units_map = {}
+
+  outputs = pd.read_csv(os.path.join(dictionary_folder, 'outputs.csv'))
+  for name_col, units_col in [('Annual Name', 'Annual Units'),
+                              ('Timeseries ResStock Name', 'Timeseries Units'),
+                              ('Timeseries BuildStockBatch Name', 'Timeseries Units')]:
+    for name, units in zip(outputs[name_col], outputs[units_col]):
+      if isinstance(name, str) and isinstance(units, str):
+        units_map[name] = units
+
+  return units_map
+
+
+class UnitRegistry:
+  # Units of each column from the data dictionary, falling back to the column name suffix for columns that are not in
+  # it (e.g., results from older versions), and the factors that convert them to common units
+  conversions = {'MBtu': 1.0,
+                 'kBtu': 1.0/1000,  # to mbtu
+                 'Btu': 1.0/1000000,  # to mbtu
+                 'kWh': 3412.14/1000000,  # to mbtu
+                 'therm': 0.1,  # to mbtu
+                 'lb': 1.0}
+  suffixes = [('_m_btu', 'MBtu'), ('_kbtu', 'kBtu'), ('_kwh', 'kWh'), ('_therm', 'therm'), ('_lb', 'lb')]
+
+  def __init__(self, dictionary_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)), '../resources/data/dictionary')):
+    self.units_map = dictionary_units(dictionary_folder)
+    with open(os.path.join(dictionary_folder, 'outputs.csv'), 'rb') as f:
+      self.dictionary_hash = hashlib.sha1(f.read()).hexdigest()
+
+  def units(self, col):
+    if col in self.units_map:
+      return self.units_map[col]
+    for suffix, units in self.suffixes:
+      if col.lower().endswith(suffix):
+        return units
+    return None
+
+  def factors(self, columns):
+    # Conversion factor of each column, 1.0 for columns with other or unknown units
+    return np.array([self.conversions.get(self.units(col), 1.0) for col in columns], dtype=np.float64)
+
+
 class MoreCompare(BaseCompare):
+  # Bump when map_plan, apply_map_plan or the unit conversions change, so map/ outputs made by older code are rewritten
+  map_version = 1
+
   def __init__(self, base_folder, feature_folder, export_folder, export_file, map_file):
     self.base_folder = base_folder
     self.feature_folder = feature_folder
@@ -28,43 +79,108 @@ class MoreCompare(BaseCompare):
       self.map_columns(map_file)
 
 
+  @staticmethod
+  def option_counts(df):
+    # Counts of every (parameter, option) pair from the category codes of each parameter, in one series indexed by
+    # (parameter, option); missing values are not counted, like value_counts
+    cols = sorted(col for col in df.columns if col != 'Building')
+    parameters = []
+    options = []
+    counts = []
+    for col in cols:
+      codes, uniques = pd.factorize(df[col])
+      parameters.append(np.repeat(col, len(uniques)))
+      options.append(np.asarray(uniques, dtype=object))
+      counts.append(np.bincount(codes[codes >= 0], minlength=len(uniques)))
+
+    index = pd.MultiIndex.from_arrays([np.concatenate(parameters) if cols else [],
+                                       np.concatenate(options) if cols else []], names=['parameter', 'option'])
+    return pd.Series(np.concatenate(counts) if cols else [], index=index, name='count', dtype=np.int64)
+
+  @staticmethod
+  def sample_divergence(base_counts, feature_counts):
+    # Per parameter total variation distance and max option share shift between base and feature shares, and the
+    # chi-square statistic of the 2 x options contingency table; parameters sampled on only one side have a total
+    # variation of 1 and name the missing side. Sorted so the largest shifts come first.
+    df = pd.concat([base_counts.rename('base'), feature_counts.rename('feature')], axis=1).fillna(0)
+    totals = df.groupby(level='parameter').transform('sum')
+    shares = (df / totals.where(totals > 0)).fillna(0)
+    df['shift'] = shares['feature'] - shares['base']
+    df['abs_shift'] = df['shift'].abs()
+    expected = df[['base', 'feature']].sum(axis=1).to_numpy()[:, np.newaxis] * totals.to_numpy() / totals.sum(axis=1).to_numpy()[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      df['chi_square'] = np.nansum((df[['base', 'feature']].to_numpy() - expected) ** 2 / expected, axis=1)
+    df['base_option'] = df['base'] > 0
+    df['feature_option'] = df['feature'] > 0
+
+    g = df.groupby(level='parameter')
+    divergence = pd.DataFrame({'total_variation': 0.5 * g['abs_shift'].sum(),
+                               'max_share_shift': g['abs_shift'].max(),
+                               'chi_square': g['chi_square'].sum(),
+                               'dof': g.size() - 1,
+                               'base_options': g['base_option'].sum(),
+                               'feature_options': g['feature_option'].sum()})
+    worst = df.loc[g['abs_shift'].idxmax()].reset_index(level='option')
+    divergence['max_shift_option'] = worst['option']
+    divergence['max_shift'] = worst['shift']
+
+    # A parameter sampled on only one side is entirely different, not half
+    missing_from = np.select([divergence['base_options'] == 0, divergence['feature_options'] == 0], ['base', 'feature'], '')
+    divergence['missing_from'] = missing_from
+    divergence.loc[missing_from != '', 'total_variation'] = 1.0
+    divergence = divergence[['total_variation', 'max_share_shift', 'max_shift_option', 'max_shift', 'chi_square', 'dof',
+                             'base_options', 'feature_options', 'missing_from']]
+    return divergence.sort_values(['total_variation', 'max_share_shift'], ascending=False, kind='stable')
+
   def samples(self):
 
-    def value_counts(df, file):
+    def write_shares(counts, parameters, file):
+      # Parameters without any sampled option (e.g., empty on this side) keep their header and empty rows
+      shares = counts / counts.groupby(level='parameter').transform('sum')
+      shares = shares.round(2)
+      shares = dict(iter(shares.groupby(level='parameter', sort=True)))
       value_counts = []
+      for col in parameters:
+        keys_to_values = {}
+        if col in shares:
+          share = shares[col]
+          keys_to_values = dict(zip(share.index.get_level_values('option'), share.values))
+        keys_to_values = dict(sorted(keys_to_values.items(), key=lambda x: (x[1], x[0]), reverse=True))
+        value_counts.append([col])
+        value_counts.append(keys_to_values.keys())
+        value_counts.append(keys_to_values.values())
+        value_counts.append('')
+
       with open(file, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerows(value_counts)
 
-        for col in sorted(df.columns):
-          if col == 'Building':
-            continue
+    base_df = read_csv(os.path.join(self.base_folder, 'buildstock.csv'), dtype=str)
+    feature_df = read_csv(os.path.join(self.feature_folder, 'buildstock.csv'), dtype=str)
+    # Both files list the parameters of either side
+    parameters = sorted(set(base_df.columns).union(feature_df.columns) - set(['Building']))
 
-          value_count = df[col].value_counts(normalize=True)
-          value_count = value_count.round(2)
-          keys_to_values = dict(zip(value_count.index.values, value_count.values))
-          keys_to_values = dict(sorted(keys_to_values.items(), key=lambda x: (x[1], x[0]), reverse=True))
-          value_counts.append([col])
-          value_counts.append(keys_to_values.keys())
-          value_counts.append(keys_to_values.values())
-          value_counts.append('')
+    base_counts = self.option_counts(base_df)
+    write_shares(base_counts, parameters, os.path.join(self.export_folder, 'base_samples.csv'))
 
-        w = csv.writer(f)
-        w.writerows(value_counts)
+    feature_counts = self.option_counts(feature_df)
+    write_shares(feature_counts, parameters, os.path.join(self.export_folder, 'feature_samples.csv'))
 
-    df = read_csv(os.path.join(self.base_folder, 'buildstock.csv'), dtype=str)
-    file = os.path.join(self.export_folder, 'base_samples.csv')
-    value_counts(df, file)
+    df = self.sample_divergence(base_counts, feature_counts)
+    df.to_csv(os.path.join(self.export_folder, 'samples_divergence.csv'))
 
-    df = read_csv(os.path.join(self.feature_folder, 'buildstock.csv'), dtype=str)
-    file = os.path.join(self.export_folder, 'feature_samples.csv')
-    value_counts(df, file)
+  @staticmethod
+  @functools.lru_cache(maxsize=None)
+  def unit_registry():
+    return UnitRegistry()
 
   def convert_units(self, df):
-    for col in df.columns:
-      units = col.split('_')[-1]
-      if units == 'kwh':
-          df[col] *= 3412.14/1000000  # to mbtu
-      elif units == 'therm':
-          df[col] *= 0.1  # to mbtu
+    # Energy columns to MBtu (and emissions to lb) with one broadcasted multiply over the columns to convert
+    factors = self.unit_registry().factors(df.columns)
+    convert = factors != 1.0
+    if convert.any():
+      cols = df.columns[convert]
+      df[cols] = df[cols].to_numpy(dtype=np.float64) * factors[convert]
 
     return
 
@@ -74,31 +190,93 @@ class MoreCompare(BaseCompare):
     feature_df.to_csv(os.path.join(self.feature_folder, 'results_output.csv'))
       
 
+  @staticmethod
+  @functools.lru_cache(maxsize=None)
+  def map_plan(map_hash, map_file):
+    # Compile a column mapping csv (keyed by its content hash) into the column groups to sum, in the order they are
+    # applied, and the renames; the renames that depend on which columns are present carry that column as a condition
+    map_df = read_csv(map_file, usecols=['map_from','map_to'])
+    map_df = map_df.dropna(axis=0)
+
+    groups = []
+    renames = []
+    for map_from, map_to in zip(map_df['map_from'], map_df['map_to']):
+      renames.append((map_from, map_to, None))
+
+      # Sum 'map to' columns and use first parameter as col name
+      map_to_s = map_to.split(',')
+      if len(map_to_s) > 1:
+        map_to = map_to_s[0]
+        groups.append((map_to, map_to_s))
+        renames.append((map_from, map_to, map_to))
+
+      # Sum 'map from' columns and use first parameter as col name
+      map_from_s = map_from.split(',')
+      if len(map_from_s) > 1:
+        groups.append((map_from_s[0], map_from_s))
+        renames.append((map_from_s[0], map_to, map_from_s[0]))
+
+    return {'hash': map_hash, 'groups': groups, 'renames': renames}
+
+  @staticmethod
+  def apply_map_plan(plan, df, present):
+    # Sum the column groups whose first column is in df with one reduceat, dropping their other columns, and return
+    # the renames; present is the set of base and feature columns, which decides the conditional renames
+    groups = [(target, sources) for target, sources in plan['groups'] if target in df.columns]
+    if groups:
+      sources = [col for _, group in groups for col in group]
+      integer = [all(pd.api.types.is_integer_dtype(df[col].dtype) for col in group) for _, group in groups]
+      values = np.nan_to_num(df[sources].to_numpy(dtype=np.float64))
+      starts = np.cumsum([0] + [len(group) for _, group in groups[:-1]])
+      sums = np.add.reduceat(values, starts, axis=1)
+
+      df = df.drop(columns=[col for _, group in groups for col in group[1:]])
+      for k, (target, _) in enumerate(groups):
+        df[target] = sums[:, k].astype(np.int64) if integer[k] else sums[:, k]
+
+    renames = {}
+    for key, value, condition in plan['renames']:
+      if condition is None or condition in present:
+        renames[key] = value
+    return df, renames
+
+  @classmethod
+  def map_stamp(cls, plan, base_folder, feature_folder):
+    # The mapping code version, the mapping file and data dictionary hashes, and the size and mtime of every input the
+    # mapped results are made from
+    inputs = {}
+    for folder in [base_folder, feature_folder]:
+      for file in ['results_output.csv', 'results_characteristics.csv']:
+        for path in [os.path.join(folder, file), BaseCompare.columnar_file(os.path.join(folder, file))]:
+          if os.path.exists(path):
+            stat = os.stat(path)
+            inputs[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns]
+    return {'map_version': cls.map_version, 'map_hash': plan['hash'], 'dictionary_hash': cls.unit_registry().dictionary_hash, 'inputs': inputs}
+
   def map_columns(self, map_file):
     # This function uses a column mapping csv (specified with the -m argument) with columns "map_from" and "map_to"
     # If a "map_from" column is found in either the base or feature results, the column will be updated to the "map_to" value
     # Any columns that do not appear in both base and feature after the mapping will be dropped
     # An entry in the column mapping csv may have multiple column headers separated by a comma, in which case the columns will be summed and first entry will be used as the column header
+    # The mapping file is compiled once per content hash (see map_plan), and the map/ outputs are only rewritten when
+    # the mapping file, the data dictionary units, the mapping code (map_version), or the results they are made from
+    # changed
+
+    ## Mapping
+    with open(map_file, 'rb') as f:
+      map_hash = hashlib.sha1(f.read()).hexdigest()
+    plan = self.map_plan(map_hash, map_file)
+    stamp = self.map_stamp(plan, self.base_folder, self.feature_folder)
 
     ## Characteristics
     # This is optional since you aren't necessarily going to visualize by characteristics
     has_characteristics = False
     if os.path.exists(os.path.join(self.base_folder, 'results_characteristics.csv')) and os.path.exists(os.path.join(self.feature_folder, 'results_characteristics.csv')):
       has_characteristics = True
-      base_df_char = read_csv(os.path.join(self.base_folder, 'results_characteristics.csv'), index_col=0)
-      feature_df_char = read_csv(os.path.join(self.feature_folder, 'results_characteristics.csv'), index_col=0)
-
-    ## Outputs
-    base_df = read_csv(os.path.join(self.base_folder, 'results_output.csv'), index_col=0)
-    feature_df = read_csv(os.path.join(self.feature_folder, 'results_output.csv'), index_col=0)
-
-    ## Mapping
-    cwd = os.path.dirname(os.path.realpath(__file__))
-    map_df = read_csv(map_file, usecols=['map_from','map_to'])
-    map_df = map_df.dropna(axis=0)
-    map_dict = {k:v for k,v in zip(map_df['map_from'], map_df['map_to'])}
 
     # Set new base and feature folders
+    base_folder = self.base_folder
+    feature_folder = self.feature_folder
     self.base_folder = os.path.join(self.base_folder, 'map')
     self.feature_folder = os.path.join(self.feature_folder, 'map')
     if not os.path.exists(self.base_folder):
@@ -106,8 +284,31 @@ class MoreCompare(BaseCompare):
     if not os.path.exists(self.feature_folder):
       os.makedirs(self.feature_folder)
 
+    stamp_files = [os.path.join(folder, '.map.json') for folder in [self.base_folder, self.feature_folder]]
+
+    def up_to_date():
+      for folder, stamp_file in zip([self.base_folder, self.feature_folder], stamp_files):
+        if not os.path.exists(os.path.join(folder, 'results_output.csv')) or not os.path.exists(stamp_file):
+          return False
+        with open(stamp_file) as f:
+          if json.load(f) != stamp:
+            return False
+      return True
+
+    def write_stamps():
+      for stamp_file in stamp_files:
+        with open(stamp_file, 'w') as f:
+          json.dump(stamp, f)
+
+    if up_to_date():
+      print("Mapped results_output.csv for base and feature results are up to date")
+      return
+
     ## Characteristics
     if has_characteristics:
+      base_df_char = self.read_results(os.path.join(base_folder, 'results_characteristics.csv'))
+      feature_df_char = self.read_results(os.path.join(feature_folder, 'results_characteristics.csv'))
+
       # Align results_charactersitics columns
       base_cols = ['build_existing_model.' + col if  'build_existing_model' not in col else col for col in base_df_char.columns]
       feature_cols = ['build_existing_model.' + col if  'build_existing_model' not in col else col for col in feature_df_char.columns]
@@ -122,53 +323,26 @@ class MoreCompare(BaseCompare):
       base_df_char.to_csv(os.path.join(self.base_folder, 'results_characteristics.csv'))
       feature_df_char.to_csv(os.path.join(self.feature_folder, 'results_characteristics.csv'))
 
+    ## Outputs
+    base_df = self.read_results(os.path.join(base_folder, 'results_output.csv'))
+    feature_df = self.read_results(os.path.join(feature_folder, 'results_output.csv'))
+
     # Skip mapping if not needed
     if set(base_df.columns).issubset(set(feature_df.columns)) or set(feature_df).issubset(set(base_df.columns)):
       self.write_results(base_df, feature_df)
+      write_stamps()
       return
 
     # Sum columns with more than 1 column header in mapping csv
-    results_dfs = {'base': base_df, 'feature': feature_df}
-    map_dict_copy = map_dict.copy()
-    for key, df in results_dfs.items():
-      column_headers = df.columns
-
-      for map_from, map_to in map_dict.items():
-        # Sum 'map to' columns and use first parameter as col name
-        map_to_s = map_to.split(',')
-        if len(map_to_s) > 1: 
-          map_to = map_to_s[0]
-          if map_to in column_headers:
-            # sum columns
-            df[map_to] = df[map_to_s].sum(axis=1)
-            # update mapping
-            map_dict_copy[map_from] = map_to 
-            # drop summed columns
-            df.drop(map_to_s[1:], axis='columns', inplace=True)
-
-        # Sum 'map from' columns and use first parameter as col name
-        map_from_s = map_from.split(',')
-        if len(map_from_s)>1:
-          map_from = map_from_s[0]
-          if map_from in column_headers:
-            # sum columns
-            df[map_from] = df[map_from_s].sum(axis=1)
-            # update mapping
-            map_dict_copy[map_from] = map_to
-            # drop summed columns
-            df.drop(map_from_s[1:], axis='columns', inplace=True)
-
-      results_dfs[key] = df
-
-    base_df = results_dfs['base']
-    feature_df = results_dfs['feature']
+    present = set(base_df.columns) | set(feature_df.columns)
+    base_df, map_dict = self.apply_map_plan(plan, base_df, present)
+    feature_df, _ = self.apply_map_plan(plan, feature_df, present)
 
     # Convert units
     self.convert_units(base_df)
     self.convert_units(feature_df)
-   
+
     # Map column headers
-    map_dict = map_dict_copy
     base_df.rename(columns=map_dict, inplace=True)
     feature_df.rename(columns=map_dict, inplace=True)
 
@@ -182,46 +356,140 @@ class MoreCompare(BaseCompare):
 
     # Store new mapped csvs
     self.write_results(base_df, feature_df)
+    write_stamps()
     print("Wrote mapped results_output.csv for base and feature results")
     return
 
 
-  def timeseries(self):
-    files = []
-    for file in os.listdir(self.base_folder):
-      files.append(file)
-
-    def cvrmse(b, f):
-      if np.all(b == 0):
-        return 'NA'
-
-      s = np.sum((b - f) ** 2)
-      s /= (len(b) - 1)
-      s **= (0.5)
-      s /= np.mean(b)
-      s *= 100.0
-      return s
-
-    def nmbe(b, f):
-      if np.all(b == 0):
-        return 'NA'
-
-      s = np.sum(b - f)
-      s /= (len(b) - 1)
-      s /= np.mean(b)
-      s *= 100.0
-      return s
-
-    metrics = ['cvrmse', 'nmbe']
+  @staticmethod
+  def timeseries_metrics(base_df, feature_df, cols):
+    # CVRMSE, NMBE, RMSE, MAE, peak error and correlation of every column for every PROJECT group, from one set of
+    # reductions over the group-sorted 2-D arrays; rows are (column, metric) and columns are the groups
+    groups = sorted(base_df.index.unique())
+
+    def group_sorted(df):
+      codes = pd.Categorical(df.index, categories=groups).codes
+      values = df[cols].to_numpy(dtype=np.float64)
+      if np.any(codes[1:] < codes[:-1]):
+        values = values[np.argsort(codes, kind='stable')]
+      return values, np.bincount(codes, minlength=len(groups))
+
+    b, counts = group_sorted(base_df)
+    f, feature_counts = group_sorted(feature_df)
+    if not np.array_equal(counts, feature_counts):
+      raise ValueError('Base and feature timeseries have different numbers of rows per PROJECT.')
+
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    def group_sum(a):
+      return np.add.reduceat(a, starts, axis=0)
+
+    n = counts[:, np.newaxis].astype(np.float64)
+    d = b - f
+    mean_b = group_sum(b) / n
+    mean_f = group_sum(f) / n
+    b_c = b - np.repeat(mean_b, counts, axis=0)
+    f_c = f - np.repeat(mean_f, counts, axis=0)
+    peak_b = np.maximum.reduceat(b, starts, axis=0)
+    peak_f = np.maximum.reduceat(f, starts, axis=0)
+    all_zero = np.maximum.reduceat(np.abs(b), starts, axis=0) == 0
+    # CVRMSE and NMBE are also NA for a single timestep
+    undefined = all_zero | (n < 2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+      sum_d2 = group_sum(d ** 2)
+      variance = group_sum(b_c ** 2) * group_sum(f_c ** 2)
+      metrics = {'CVRMSE (%)': (np.sqrt(sum_d2 / (n - 1)) / mean_b * 100.0, undefined),
+                 'NMBE (%)': (group_sum(d) / (n - 1) / mean_b * 100.0, undefined),
+                 'RMSE': (np.sqrt(sum_d2 / n), None),
+                 'MAE': (group_sum(np.abs(d)) / n, None),
+                 'Peak Error (%)': ((peak_f - peak_b) / peak_b * 100.0, all_zero),
+                 'Correlation': (group_sum(b_c * f_c) / np.sqrt(variance), variance == 0)}
+
+    values = []
+    for value, not_applicable in metrics.values():
+      value = value.astype(object)
+      if not_applicable is not None:
+        value[not_applicable] = 'NA'
+      values.append(value)
+
+    # (metric, group, column) -> (column, metric) x group
+    values = np.stack(values).transpose(2, 0, 1).reshape(len(cols) * len(metrics), len(groups))
+    index = pd.MultiIndex.from_product([cols, list(metrics)])
+    return pd.DataFrame(values, index=index, columns=groups)
+
+  @staticmethod
+  def downsample(df, time_col, cols, resolutions, timestamp_convention='start', project_conventions=None):
+    # Sums of cols per PROJECT and period for each of resolutions ('hourly', 'daily' or 'monthly') that is not finer
+    # than the file's timestep. All resolutions are differences of one cumulative sum over the rows sorted
+    # by PROJECT and time. Timestamps mark the start (the OS-HPXML default) or the end of each timestep, per the
+    # timeseries_timestamp_convention of the project's yml; project_conventions overrides it for some projects.
+    codes, projects = pd.factorize(df.index, sort=True)
+    times = pd.to_datetime(df[time_col]).to_numpy()
+    values = df[cols].to_numpy(dtype=np.float64)
+
+    order = np.lexsort((times, codes))
+    if np.any(order != np.arange(len(order))):
+      codes, times, values = codes[order], times[order], values[order]
+    index = df.index[order]
+
+    same_group = codes[1:] == codes[:-1]
+    if not same_group.any():
+      return {}
+    step = np.median(np.diff(times)[same_group])
+    project_conventions = project_conventions or {}
+    ends = np.array([project_conventions.get(project, timestamp_convention) == 'end' for project in projects])
+    period_starts = np.where(ends[codes], times - step, times)
+
+    units = {'hourly': ('h', np.timedelta64(1, 'h')),
+             'daily': ('D', np.timedelta64(1, 'D')),
+             'monthly': ('M', np.timedelta64(28, 'D'))}
+
+    cumsum = None
+    periods = {}
+    for resolution in resolutions:
+      new_period = np.ones(len(codes), dtype=bool)
+      unit, length = units[resolution]
+      if length < step:
+        continue
+      keys = period_starts.astype('datetime64[{}]'.format(unit)).astype(np.int64)
+      new_period[1:] = ~same_group | (keys[1:] != keys[:-1])
+
+      starts = np.flatnonzero(new_period)
+      if len(starts) == len(values):
+        sums = values
+      else:
+        if cumsum is None:
+          cumsum = np.concatenate([np.zeros((1, len(cols))), np.cumsum(values, axis=0)])
+        ends = np.append(starts[1:], len(values))
+        sums = cumsum[ends] - cumsum[starts]
+      periods[resolution] = pd.DataFrame(sums, index=index[starts], columns=cols)
+
+    return periods
+
+  @staticmethod
+  def totals(base_df, feature_df, cols):
+    # Base and feature totals and their difference; rows are (column, metric) and columns are the groups
+    base_df = base_df[cols].groupby(level=0, sort=True).sum()
+    feature_df = feature_df[cols].groupby(level=0, sort=True).sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+      difference = 100.0 * (feature_df - base_df) / base_df
+    values = np.stack([base_df[cols].to_numpy(), feature_df[cols].to_numpy(), difference[cols].to_numpy()])
+    metrics = ['Base Total', 'Feature Total', 'Total Difference (%)']
+    values = values.transpose(2, 0, 1).reshape(len(cols) * len(metrics), len(base_df))
+    return pd.DataFrame(values, index=pd.MultiIndex.from_product([cols, metrics]), columns=list(base_df.index))
+
+  def timeseries(self, resolutions=['hourly', 'daily', 'monthly'], timestamp_convention='start', project_conventions=None):
+    files = self.list_files(self.base_folder)
 
     for file in sorted(files):
-      base_df = read_csv(os.path.join(self.base_folder, file), index_col=0)
-      feature_df = read_csv(os.path.join(self.feature_folder, file), index_col=0)
+      base_df = self.read_results(os.path.join(self.base_folder, file))
+      feature_df = self.read_results(os.path.join(self.feature_folder, file))
 
       base_df = self.intersect_rows(base_df, feature_df)
       feature_df = self.intersect_rows(feature_df, base_df)
 
-      cols = sorted(list(set(base_df.columns) & set(feature_df.columns)))
+      cols = self.prune_columns(base_df, feature_df)
 
       for time_col in ['Time', 'time']:
         if time_col in cols:
@@ -230,38 +498,195 @@ class MoreCompare(BaseCompare):
       if not cols:
         return
 
-      g = base_df.groupby('PROJECT')
-      groups = g.groups.keys()
-
-      dfs = []
-      for group in groups:
-        b_df = base_df.copy()
-        f_df = feature_df.copy()
-
-        cdfs = []
-        for col in cols:
-          b = b_df.loc[group][col].values
-          f = f_df.loc[group][col].values
-
-          data = {'CVRMSE (%)': [cvrmse(b, f)], 'NMBE (%)': [nmbe(b, f)]}
-          df = pd.DataFrame(data=data, index=[group])
-          columns = [(col, 'CVRMSE (%)'), (col, 'NMBE (%)')]
-          df.columns = pd.MultiIndex.from_tuples(columns)
-          cdfs.append(df)
+      df = self.timeseries_metrics(base_df, feature_df, cols)
+      cvrmse_nmbe = df.index.get_level_values(1).isin(['CVRMSE (%)', 'NMBE (%)'])
+      df[cvrmse_nmbe].to_csv(os.path.join(self.export_folder, 'cvrmse_nmbe_{}'.format(file)))
+
+      # One report with the metrics at each resolution and the totals, from a single read of the file
+      reports = {'native': df}
+      time_col = next((time_col for time_col in ['Time', 'time'] if time_col in base_df.columns), None)
+      if time_col:
+        base_periods = self.downsample(base_df, time_col, cols, resolutions, timestamp_convention, project_conventions)
+        feature_periods = self.downsample(feature_df, time_col, cols, resolutions, timestamp_convention, project_conventions)
+        for resolution in base_periods:
+          reports[resolution] = self.timeseries_metrics(base_periods[resolution], feature_periods[resolution], cols)
+      reports['total'] = self.totals(base_df, feature_df, cols)
+      pd.concat(reports).to_csv(os.path.join(self.export_folder, 'timeseries_metrics_{}'.format(file)))
+
+  @staticmethod
+  def row_groups(folder, id_col='building_id'):
+    # (file, row group, min id, max id) of every row group of the parquet files in folder, from the file footers
+    # only; row groups without statistics could hold any building
+    import pyarrow.parquet as pq
+    groups = []
+    for file in sorted(os.listdir(folder)):
+      if not file.endswith('.parquet'):
+        continue
+      path = os.path.join(folder, file)
+      metadata = pq.ParquetFile(path).metadata
+      for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        low, high = -np.inf, np.inf
+        for j in range(row_group.num_columns):
+          column = row_group.column(j)
+          if column.path_in_schema == id_col and column.statistics is not None and column.statistics.has_min_max:
+            low, high = column.statistics.min, column.statistics.max
+        groups.append((path, i, low, high))
+
+    return sorted(groups, key=lambda group: (group[2], group[3]))
+
+  @staticmethod
+  def building_stats(base_df, feature_df, cols):
+    # Additive per-building sums of one aligned batch, so buildings split across batches can be combined by summing
+    # (and taking the max of the peaks); rows are building ids and columns are (stat, column)
+    codes, ids = pd.factorize(base_df.index.get_level_values(0))
+    b = base_df[cols].to_numpy(dtype=np.float64)
+    f = feature_df[cols].to_numpy(dtype=np.float64)
+    if np.any(codes[1:] < codes[:-1]):
+      order = np.argsort(codes, kind='stable')
+      codes, b, f = codes[order], b[order], f[order]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1])
+
+    def group_sum(a):
+      return np.add.reduceat(a, starts, axis=0)
+
+    d = b - f
+    stats = {'n': np.repeat(np.diff(np.append(starts, len(codes)))[:, np.newaxis], len(cols), axis=1).astype(np.float64),
+             'sum_b': group_sum(b),
+             'sum_f': group_sum(f),
+             'sum_d': group_sum(d),
+             'sum_d2': group_sum(d ** 2),
+             'sum_abs_d': group_sum(np.abs(d)),
+             'sum_b2': group_sum(b ** 2),
+             'sum_f2': group_sum(f ** 2),
+             'sum_bf': group_sum(b * f),
+             'peak_b': np.maximum.reduceat(b, starts, axis=0),
+             'peak_f': np.maximum.reduceat(f, starts, axis=0),
+             'max_abs_b': np.maximum.reduceat(np.abs(b), starts, axis=0)}
+
+    columns = pd.MultiIndex.from_product([list(stats), cols])
+    return pd.DataFrame(np.concatenate(list(stats.values()), axis=1), index=ids[codes[starts]], columns=columns)
+
+  @staticmethod
+  def building_metrics(stats, cols):
+    # The timeseries_metrics of each (building, column) from the combined sums; rows are (building_id, column)
+    def stat(name):
+      return stats[name].to_numpy()
+
+    n = stat('n')
+    mean_b = stat('sum_b') / n
+    all_zero = stat('max_abs_b') == 0
+    undefined = all_zero | (n < 2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+      variance = (stat('sum_b2') - stat('sum_b') ** 2 / n) * (stat('sum_f2') - stat('sum_f') ** 2 / n)
+      metrics = {'CVRMSE (%)': (np.sqrt(stat('sum_d2') / (n - 1)) / mean_b * 100.0, undefined),
+                 'NMBE (%)': (stat('sum_d') / (n - 1) / mean_b * 100.0, undefined),
+                 'RMSE': (np.sqrt(stat('sum_d2') / n), None),
+                 'MAE': (stat('sum_abs_d') / n, None),
+                 'Peak Error (%)': ((stat('peak_f') - stat('peak_b')) / stat('peak_b') * 100.0, all_zero),
+                 'Correlation': ((stat('sum_bf') - stat('sum_b') * stat('sum_f') / n) / np.sqrt(variance), ~(variance > 0))}
+
+    values = {}
+    for metric, (value, not_applicable) in metrics.items():
+      if not_applicable is not None:
+        value = np.where(not_applicable, np.nan, value)
+      values[metric] = value.ravel()
+
+    index = pd.MultiIndex.from_product([stats.index, cols], names=['building_id', 'column'])
+    return pd.DataFrame(values, index=index)
+
+  def timeseries_buildings(self, upgrade=0, top_k=None):
+    # Compare parquet/timeseries/upgrade=N of two buildstockbatch output directories building by building, so errors
+    # in individual buildings do not cancel out in the project sums. Base row groups are read one at a time with only
+    # the feature row groups that can hold their buildings, aligned on (building_id, time), and reduced to additive
+    # per-building sums.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    index_cols = ['building_id', 'time']
+    skips = set(index_cols + ['timedst', 'timeutc', 'upgrade'])
+    folders = [os.path.join(folder, 'parquet', 'timeseries', 'upgrade={}'.format(upgrade)) for folder in [self.base_folder, self.feature_folder]]
+
+    def value_columns(path):
+      schema = pq.read_schema(path)
+      return [field.name for field in schema if field.name not in skips and not field.name.startswith('__index_level_') and
+              (pa.types.is_integer(field.type) or pa.types.is_floating(field.type))]
+
+    base_groups = self.row_groups(folders[0])
+    feature_groups = self.row_groups(folders[1])
+    if not base_groups or not feature_groups:
+      return
 
-        df = pd.concat(cdfs, axis=1)
-        dfs.append(df)
+    # Columns of any file on both sides; row groups of files without a column read it as NaN
+    file_cols = {path: value_columns(path) for path in set(group[0] for group in base_groups + feature_groups)}
+    base_cols = set(col for group in base_groups for col in file_cols[group[0]])
+    feature_cols = set(col for group in feature_groups for col in file_cols[group[0]])
+    cols = sorted(base_cols & feature_cols)
+
+    def read_row_group(path, i):
+      # Ignore the pandas metadata so building_id and time are columns even when they were written as the index
+      columns = [col for col in cols if col in file_cols[path]]
+      df = pq.ParquetFile(path).read_row_group(i, columns=index_cols + columns).to_pandas(ignore_metadata=True)
+      return df.set_index(index_cols).reindex(columns=cols)
+
+    # Feature row groups stay loaded until the base row groups, in order of their smallest building, move past them
+    loaded = {}
+    partials = []
+    for path, i, _, _ in base_groups:
+      base_df = read_row_group(path, i)
+      if base_df.empty:
+        continue
+      low, high = base_df.index.get_level_values(0).min(), base_df.index.get_level_values(0).max()
+      for key in [key for key in loaded if key[3] < low]:
+        del loaded[key]
+      for group in feature_groups:
+        if group[2] <= high and group[3] >= low and group not in loaded:
+          loaded[group] = read_row_group(group[0], group[1])
+
+      # None of these buildings are in the feature run
+      if not loaded:
+        continue
+
+      ids = base_df.index.unique(level=0)
+      feature_df = pd.concat([df[df.index.get_level_values(0).isin(ids)] for df in loaded.values()])
+      base_df, feature_df = self.align_rows(base_df, feature_df)
+      if not base_df.empty:
+        partials.append(self.building_stats(base_df, feature_df, cols))
+
+    if not partials:
+      return
 
-      df = pd.concat(dfs).transpose()
-      df.to_csv(os.path.join(self.export_folder, 'cvrmse_nmbe_{}'.format(file)))
+    stats = pd.concat(partials)
+    if stats.index.has_duplicates:
+      peaks = stats.columns.get_level_values(0).isin(['peak_b', 'peak_f', 'max_abs_b'])
+      grouped = stats.groupby(level=0, sort=False)
+      # A column missing from any batch of a building stays missing rather than summing only the other batches
+      missing = stats.isna().groupby(level=0, sort=False).any()
+      stats = grouped.sum()
+      stats.loc[:, peaks] = grouped.max().loc[:, peaks]
+      stats = stats.mask(missing)
+    stats = stats.sort_index()
+
+    df = self.building_metrics(stats, cols)
+    df.to_csv(os.path.join(self.export_folder, 'timeseries_buildings_up{:02d}.csv'.format(upgrade)), na_rep='NA')
+
+    # Rank buildings by the worst CVRMSE of any of their columns
+    cvrmse = df['CVRMSE (%)'].unstack('column')
+    nmbe = df['NMBE (%)'].abs().unstack('column')
+    worst = pd.DataFrame({'Worst Column': cvrmse.fillna(-np.inf).idxmax(axis=1).where(cvrmse.notna().any(axis=1)),
+                          'Max CVRMSE (%)': cvrmse.max(axis=1),
+                          'Max Abs NMBE (%)': nmbe.max(axis=1)})
+    worst = worst.sort_values(['Max CVRMSE (%)', 'Max Abs NMBE (%)'], ascending=False, na_position='last')
+    if top_k is not None:
+      worst = worst.head(top_k)
+    worst.to_csv(os.path.join(self.export_folder, 'timeseries_buildings_worst_up{:02d}.csv'.format(upgrade)), na_rep='NA')
 
 if __name__ == '__main__':
 
   default_base_folder = 'test/base_results/baseline'
   default_feature_folder = 'test/base_results/results'
   default_export_folder = 'test/base_results/comparisons'
-  actions = [method for method in dir(MoreCompare) if method.startswith('__') is False]
-  actions += ['timeseries']
+  actions = ['samples', 'results', 'gate', 'visualize', 'timeseries', 'timeseries_buildings']
   aggregate_columns = ['build_existing_model.geometry_building_type_recs',
                        'build_existing_model.census_region']
   aggregate_functions = ['sum', 'mean']
@@ -269,6 +694,7 @@ if __name__ == '__main__':
                      'build_existing_model.geometry_foundation_type',
                      'build_existing_model.census_region']
   map_result_choices = ['base', 'feature']
+  timestamp_conventions = ['start', 'end']
 
   parser = argparse.ArgumentParser()
   parser.add_argument('-b', '--base_folder', default=default_base_folder, help='The path of the base folder.')
@@ -280,13 +706,36 @@ if __name__ == '__main__':
   parser.add_argument('-af', '--aggregate_function', choices=aggregate_functions, help='Function to use for aggregating data.')
   parser.add_argument('-dc', '--display_column', choices=display_columns, help='How to organize the subplots.')
   parser.add_argument('-m', '--map_file', help='Column mapping csv path.')
+  parser.add_argument('-gl', '--webgl', action='store_true', help='Render large comparison plots with WebGL and one shared plotly.min.js.')
+  parser.add_argument('-mp', '--max_points', type=int, help='Maximum number of points per subplot; points outside the +/- 10%% error lines are always kept.')
+  parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes for rendering the category figures.')
+  parser.add_argument('-t', '--tolerance_file', help='Tolerances csv (pattern, abs, rel) for the gate action; values must match exactly otherwise.')
+  parser.add_argument('-k', '--top_k', type=int, help='Collect the k worst failing columns for the gate action instead of stopping at the first, or the k worst buildings for the timeseries_buildings action.')
+  parser.add_argument('-cs', '--chunksize', type=int, help='Compare results in chunks of this many rows; files must be sorted by their index.')
+  parser.add_argument('-dt', '--dictionary_folder', help='Read results csvs with the compact dtypes (categoricals and float32) of this data dictionary folder, e.g., resources/data/dictionary.')
+  parser.add_argument('-u', '--upgrade', type=int, default=0, help='The parquet/timeseries upgrade to compare building by building for the timeseries_buildings action.')
+  parser.add_argument('-tc', '--timestamp_convention', nargs='+', default=['start'], help='The timeseries_timestamp_convention (start or end) of the timeseries results, and PROJECT=convention for projects that differ, e.g., start project_testing=end.')
 
   args = parser.parse_args()
   print(args)
 
+  timestamp_convention = 'start'
+  project_conventions = {}
+  for value in args.timestamp_convention:
+    project, _, convention = value.rpartition('=')
+    if convention not in timestamp_conventions:
+      parser.error('argument -tc/--timestamp_convention: invalid convention: {}'.format(value))
+    if project:
+      project_conventions[project] = convention
+    else:
+      timestamp_convention = convention
+
   if not os.path.exists(args.export_folder):
     os.makedirs(args.export_folder)
     
+  if args.dictionary_folder:
+    MoreCompare.dtype_map = dictionary_dtype_map(args.dictionary_folder)
+
   compare = MoreCompare(args.base_folder, args.feature_folder, args.export_folder, args.export_file, args.map_file)
 
   if args.actions == None:
@@ -297,16 +746,46 @@ if __name__ == '__main__':
       compare.samples()
     elif action == 'results':
       excludes = ['buildstock.csv']
-      compare.results(args.aggregate_column, args.aggregate_function, excludes, enum_maps)
+      if args.chunksize:
+        compare.results_chunked(args.aggregate_column, args.aggregate_function, excludes, enum_maps, args.chunksize)
+      else:
+        compare.results(args.aggregate_column, args.aggregate_function, excludes, enum_maps)
+    elif action == 'gate':
+      excludes = ['buildstock.csv']
+      tolerances = read_tolerances(args.tolerance_file) if args.tolerance_file else []
+      if not compare.gate(tolerances, args.top_k, excludes).empty:
+        sys.exit(1)
     elif action == 'visualize':
       excludes = ['buildstock.csv', 'results_characteristics.csv']
       categories = ['.component_load_', '.emissions_', '.end_use_', '.energy_use_', '.fuel_use_', '.hot_water_', '.hvac_', '.load_', '.peak_', '.resilience_', '.unmet_hours_', 'report_utility_bills.', 'upgrade_costs.', 'qoi_report.']
+      # Results are read (and mapped) once, then split into one figure per category
+      compare.cache = {}
+      visualize_export_file = args.export_file
+      tasks = []
       for category in categories:
-        export_file, ext = args.export_file.split('.')
+        export_file, ext = visualize_export_file.split('.')
         export_file = '{}_{}.{}'.format(export_file, category.strip('.').rstrip('_'), ext)
         cols_to_ignore = ['color_index'] + categories
         cols_to_ignore.remove(category)
-        compare = MoreCompare(args.base_folder, args.feature_folder, args.export_folder, export_file, args.map_file)
-        compare.visualize(args.aggregate_column, args.aggregate_function, args.display_column, excludes, enum_maps, cols_to_ignore)
+        tasks.append((export_file, {'aggregate_column': args.aggregate_column,
+                                    'aggregate_function': args.aggregate_function,
+                                    'display_column': args.display_column,
+                                    'excludes': excludes,
+                                    'enum_maps': enum_maps,
+                                    'cols_to_ignore': cols_to_ignore,
+                                    'webgl': args.webgl,
+                                    'max_points': args.max_points,
+                                    'include_plotlyjs': 'directory' if args.webgl else True}))
+
+      if args.jobs > 1:
+        visualize_parallel(compare, tasks, args.jobs)
+      else:
+        for export_file, kwargs in tasks:
+          compare.export_file = export_file
+          compare.visualize(**kwargs)
+      compare.export_file = visualize_export_file
+      compare.cache = None
     elif action == 'timeseries':
-      compare.timeseries()
+      compare.timeseries(timestamp_convention=timestamp_convention, project_conventions=project_conventions)
+    elif action == 'timeseries_buildings':
+      compare.timeseries_buildings(args.upgrade, args.top_k)
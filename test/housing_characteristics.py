@@ -0,0 +1,198 @@
+import io
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+
+option_key = 'Option='
+dep_key = 'Dependency='
+count_cols = ['source_count', 'source_weight', 'sampling_probability']
+cache_version = 1
+
+
+class Characteristic:
+  # One housing characteristics tsv as typed arrays: each dependency column as integer codes into its options (in
+  # order of first appearance, like TsvFile in resources/buildstock.rb), the option probabilities as a float matrix,
+  # and source_count, source_weight and sampling_probability (None where the tsv has no such column)
+  def __init__(self, name, dependencies, categories, codes, options, probabilities, counts):
+    self.name = name
+    self.dependencies = dependencies
+    self.categories = categories
+    self.codes = codes
+    self.options = options
+    self.probabilities = probabilities
+    self.source_count = counts.get('source_count')
+    self.source_weight = counts.get('source_weight')
+    self.sampling_probability = counts.get('sampling_probability')
+
+  def to_frame(self):
+    # Dependency columns as pandas categoricals, followed by the option probabilities and counts
+    data = {}
+    for i, dependency in enumerate(self.dependencies):
+      data[dep_key + dependency] = pd.Categorical.from_codes(self.codes[:, i], categories=self.categories[i])
+    for i, option in enumerate(self.options):
+      data[option_key + option] = self.probabilities[:, i]
+    for col in count_cols:
+      if getattr(self, col) is not None:
+        data[col] = getattr(self, col)
+    return pd.DataFrame(data)
+
+  def arrays(self):
+    # Flat arrays for np.savez; strings are stored as fixed-width unicode so no pickling is needed to load them
+    arrays = {'dependencies': np.array(self.dependencies, dtype=str),
+              'codes': self.codes,
+              'options': np.array(self.options, dtype=str),
+              'probabilities': self.probabilities}
+    for i, categories in enumerate(self.categories):
+      arrays['categories_{}'.format(i)] = np.array(categories, dtype=str)
+    for col in count_cols:
+      if getattr(self, col) is not None:
+        arrays[col] = getattr(self, col)
+    return arrays
+
+  @classmethod
+  def from_arrays(cls, name, arrays):
+    dependencies = arrays['dependencies'].tolist()
+    categories = [arrays['categories_{}'.format(i)].tolist() for i in range(len(dependencies))]
+    counts = {col: arrays[col] for col in count_cols if col in arrays}
+    return cls(name, dependencies, categories, arrays['codes'], arrays['options'].tolist(), arrays['probabilities'], counts)
+
+
+def parse_tsv(tsv_path):
+  # Comment rows (starting with #) are dropped before parsing; dependency values are kept as text, e.g., "None"
+  with open(tsv_path, encoding='utf-8') as f:
+    lines = [line for line in f if not line.startswith('#') and line.strip()]
+
+  if not lines:
+    raise ValueError('Could not find header row in {}.'.format(os.path.basename(tsv_path)))
+
+  header = [col.strip() for col in lines[0].rstrip('\r\n').split('\t')]
+  dep_cols = [col for col in header if col.startswith(dep_key)]
+  option_cols = [col for col in header if col.startswith(option_key)]
+  if not option_cols:
+    raise ValueError('No options found in {}.'.format(os.path.basename(tsv_path)))
+
+  dtype = {col: str for col in dep_cols}
+  dtype.update({col: np.float64 for col in option_cols + count_cols})
+  df = pd.read_csv(io.StringIO(''.join(lines)), sep='\t', index_col=False, na_filter=False, dtype=dtype,
+                   usecols=lambda col: col.strip() in dep_cols + option_cols + count_cols)
+  df.columns = df.columns.str.strip()
+
+  codes = np.empty((len(df), len(dep_cols)), dtype=np.int32)
+  categories = []
+  for i, col in enumerate(dep_cols):
+    codes[:, i], uniques = pd.factorize(df[col])
+    categories.append(uniques.tolist())
+
+  counts = {}
+  for col in count_cols:
+    if col in df.columns:
+      counts[col] = df[col].to_numpy()
+  if 'source_count' in counts and np.all(np.mod(counts['source_count'], 1) == 0):
+    counts['source_count'] = counts['source_count'].astype(np.int64)
+
+  name = os.path.splitext(os.path.basename(tsv_path))[0]
+  return Characteristic(name,
+                        [col[len(dep_key):].strip() for col in dep_cols],
+                        categories,
+                        codes,
+                        [col[len(option_key):].strip() for col in option_cols],
+                        df[option_cols].to_numpy(dtype=np.float64),
+                        counts)
+
+
+class HousingCharacteristics:
+  # Loads the tsvs of a housing_characteristics directory, caching each parsed file as an .npz keyed by the sha1 of
+  # its contents. A small index of the size, mtime and hash of every tsv lets unchanged files skip the hashing too.
+  def __init__(self, characteristics_dir, cache_dir=None):
+    self.characteristics_dir = characteristics_dir
+    if cache_dir is None:
+      cache_dir = os.path.join(characteristics_dir, '__pycache__')
+    self.cache_dir = cache_dir
+    self.index_file = os.path.join(cache_dir, 'housing_characteristics.json')
+    self.index = {}
+    if os.path.exists(self.index_file):
+      with open(self.index_file) as f:
+        self.index = json.load(f)
+
+  def names(self):
+    return sorted(os.path.splitext(file)[0] for file in os.listdir(self.characteristics_dir) if file.endswith('.tsv'))
+
+  def file_hash(self, tsv_path):
+    stat = os.stat(tsv_path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    entry = self.index.get(os.path.basename(tsv_path))
+    if entry is not None and entry['stamp'] == stamp:
+      return entry['hash']
+
+    with open(tsv_path, 'rb') as f:
+      file_hash = hashlib.sha1(f.read()).hexdigest()
+    self.index[os.path.basename(tsv_path)] = {'stamp': stamp, 'hash': file_hash}
+    return file_hash
+
+  def cache_file(self, file_hash):
+    return os.path.join(self.cache_dir, '{}-v{}.npz'.format(file_hash, cache_version))
+
+  def load(self, name):
+    tsv_path = os.path.join(self.characteristics_dir, name + '.tsv')
+    cache_file = self.cache_file(self.file_hash(tsv_path))
+    if os.path.exists(cache_file):
+      with np.load(cache_file) as arrays:
+        return Characteristic.from_arrays(name, arrays)
+
+    characteristic = parse_tsv(tsv_path)
+    if not os.path.exists(self.cache_dir):
+      os.makedirs(self.cache_dir)
+    # Write to a temporary file first so an interrupted run never leaves a partial cache file behind
+    tmp_file = cache_file + '.tmp.npz'
+    np.savez(tmp_file, **characteristic.arrays())
+    os.replace(tmp_file, cache_file)
+    return characteristic
+
+  def load_all(self, names=None):
+    if names is None:
+      names = self.names()
+    characteristics = {name: self.load(name) for name in names}
+    self.write_index()
+    return characteristics
+
+  def write_index(self):
+    if not os.path.exists(self.cache_dir):
+      os.makedirs(self.cache_dir)
+    with open(self.index_file, 'w') as f:
+      json.dump(self.index, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+
+  default_characteristics_dir = 'project_national/housing_characteristics'
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-d', '--characteristics_dir', default=default_characteristics_dir, help='The path of the housing_characteristics directory.')
+  parser.add_argument('-c', '--cache_dir', help='Where to cache the parsed tsvs; defaults to __pycache__ in the characteristics directory.')
+  parser.add_argument('-n', '--names', nargs='+', help='The characteristics to load; defaults to all tsvs.')
+  parser.add_argument('-x', '--export_file', help='The path of a csv summarizing the loaded characteristics.')
+
+  args = parser.parse_args()
+
+  if not os.path.isdir(args.characteristics_dir):
+    sys.exit('Could not find {}.'.format(args.characteristics_dir))
+
+  start = time.perf_counter()
+  characteristics = HousingCharacteristics(args.characteristics_dir, args.cache_dir).load_all(args.names)
+  print('Loaded {} characteristics in {:.2f} s.'.format(len(characteristics), time.perf_counter() - start))
+
+  if args.export_file:
+    rows = []
+    for name, characteristic in characteristics.items():
+      rows.append({'name': name,
+                   'rows': len(characteristic.probabilities),
+                   'dependencies': '|'.join(characteristic.dependencies),
+                   'options': len(characteristic.options),
+                   'source_count': characteristic.source_count is not None})
+    pd.DataFrame(rows).to_csv(args.export_file, index=False)
@@ -1,322 +1,585 @@
 import os
 import sys
+import argparse
+import functools
+import hashlib
+import json
+import re
+import numpy as np
 import pandas as pd
-from functools import reduce
-import csv
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.abspath(__file__), '../../resources/hpxml-measures/workflow/tests')))
-from compare import read_csv
-
-
-if __name__ == '__main__':
-
-    col_exclusions = ['applicable',
-                      'include_annual_',
-                      'include_timeseries_',
-                      'output_format',
-                      'timeseries_frequency',
-                      'timestamp_convention',
-                      'timeseries_num_decimal_places',
-                      'upgrade_name',
-                      'add_timeseries_',
-                      'user_output_variables',
-                      'debug',
-                      'include_monthly_',
-                      'register_annual_',
-                      'register_monthly_']
-
-    # BASELINE
-
-    if not os.path.exists('baseline'):
-      os.makedirs('baseline')
-
-    df_national = read_csv('project_national/national_baseline/results_csvs/results_up00.csv')
-    df_national['building_id'] = df_national['building_id'].apply(lambda x: 'project_national-{}.osw'.format('%04d' % x))
-    df_national.insert(1, 'color_index', 1)
-
-    df_testing = read_csv('project_testing/testing_baseline/results_csvs/results_up00.csv')
-    df_testing['building_id'] = df_testing['building_id'].apply(lambda x: 'project_testing-{}.osw'.format('%04d' % x))
-    df_testing.insert(1, 'color_index', 0)
-
-    frames = [df_national, df_testing]
-    df = pd.concat(frames)
-    df = df.rename(columns={'building_id': 'OSW'})
-    del df['job_id']
-
-    build_existing_models = []
-    report_simulation_outputs = ['color_index']
-    report_utility_bills = []
-    upgrade_costs = []
-    qoi_reports = []
-
-    for col in df.columns.values:
-      if any([col_exclusion in col for col_exclusion in col_exclusions]):
-        continue
-
-      if col.startswith('build_existing_model'):
-        build_existing_models.append(col)
-      elif col.startswith('report_simulation_output'):
-        report_simulation_outputs.append(col)
-      elif col.startswith('report_utility_bills'):
-        report_utility_bills.append(col)
-      elif col.startswith('upgrade_costs'):
-        if not 'upgrade_cost_usd' in col:
-            upgrade_costs.append(col)
-      elif col.startswith('qoi_report'):
-        qoi_reports.append(col)
-
-    build_existing_models = sorted(build_existing_models)
-    report_simulation_outputs = sorted(report_simulation_outputs)
-    report_utility_bills = sorted(report_utility_bills)
-    upgrade_costs = sorted(upgrade_costs)
-    qoi_reports = sorted(qoi_reports)
-
-    # Annual
-
-    outdir = 'baseline/annual'
-    if not os.path.exists(outdir):
-      os.makedirs(outdir)
-
-    # results_characteristics.csv
-    results_characteristics = df[['OSW'] + build_existing_models]
+from compare import columnar_metadata, read_csv
+from bsb_query import accumulate
+
+
+def read_timeseries(file, index_col, drops):
+  df = read_csv(file, index_col=index_col, skiprows=[1])
+  df = df.drop(drops, axis=1)
+  return df
+
+
+def sum_timeseries(files, index_col, drops):
+  return accumulate(read_timeseries(file, index_col, drops) for file in files)
+
+
+def read_results(files):
+  return read_csv(files[0])
+
+
+def building_clusters(files, id_col='building_id'):
+  # Files whose building_id ranges (from the parquet footers) overlap, in building order; each cluster holds every
+  # row of its buildings. Files keep their given order within a cluster, and files without statistics merge
+  # everything into one cluster.
+  ranges = []
+  for position, file in enumerate(files):
+    low, high = None, None
+    metadata = pq.ParquetFile(file).metadata
+    for i in range(metadata.num_row_groups):
+      row_group = metadata.row_group(i)
+      stats = [row_group.column(j).statistics for j in range(row_group.num_columns) if row_group.column(j).path_in_schema == id_col]
+      if not stats or stats[0] is None or not stats[0].has_min_max:
+        low, high = -float('inf'), float('inf')
+        break
+      low = stats[0].min if low is None else min(low, stats[0].min)
+      high = stats[0].max if high is None else max(high, stats[0].max)
+    if low is not None:
+      ranges.append((low, high, position))
+
+  clusters = []
+  for low, high, position in sorted(ranges):
+    if clusters and low <= clusters[-1]['high']:
+      clusters[-1]['high'] = max(clusters[-1]['high'], high)
+      clusters[-1]['positions'].append(position)
+    else:
+      clusters.append({'high': high, 'positions': [position]})
+
+  return [[files[position] for position in sorted(cluster['positions'])] for cluster in clusters]
+
+
+class OrderedGroupSum:
+  # Same result as concatenating every frame, sorting by building_id and time, and groupby(index_col).sum(): rows are
+  # added to each group in that order with the same compensated (Kahan) summation pandas uses, so the totals match
+  # to the last bit while only one cluster of buildings is in memory at a time. Integer columns are summed exactly.
+  def __init__(self, columns, int_columns):
+    self.columns = columns
+    self.int_columns = [col for col in columns if col in int_columns]
+    self.float_columns = [col for col in columns if col not in int_columns]
+    self.keys = None
+    self.sums = np.zeros((0, len(self.float_columns)))
+    self.compensation = np.zeros((0, len(self.float_columns)))
+    self.int_sums = np.zeros((0, len(self.int_columns)), dtype=np.int64)
+
+  def slots(self, keys):
+    new_keys = pd.Index(keys).unique()
+    if self.keys is None:
+      self.keys = new_keys[:0]
+    new_keys = new_keys.difference(self.keys)
+    if len(new_keys):
+      self.keys = self.keys.append(new_keys)
+      self.sums = np.concatenate([self.sums, np.zeros((len(new_keys), len(self.float_columns)))])
+      self.compensation = np.concatenate([self.compensation, np.zeros((len(new_keys), len(self.float_columns)))])
+      self.int_sums = np.concatenate([self.int_sums, np.zeros((len(new_keys), len(self.int_columns)), dtype=np.int64)])
+    return self.keys.get_indexer(keys)
+
+  def add(self, keys, df):
+    # Rows of df in summation order
+    slots = self.slots(keys)
+    np.add.at(self.int_sums, slots, df[self.int_columns].to_numpy(dtype=np.int64))
+
+    # Rows are taken in rounds of at most one row per group, which keeps each group's order
+    values = df[self.float_columns].to_numpy(dtype=np.float64)
+    rounds = pd.Series(slots).groupby(slots).cumcount().to_numpy()
+    order = np.argsort(rounds, kind='stable')
+    bounds = np.flatnonzero(np.diff(rounds[order])) + 1
+    for rows in np.split(order, bounds):
+      slot = slots[rows]
+      value = values[rows]
+      sums = self.sums[slot]
+      y = value - self.compensation[slot]
+      t = sums + y
+      compensation = t - sums - y
+      # An infinite value leaves a NaN compensation, which pandas resets to 0
+      compensation[compensation != compensation] = 0
+      present = value == value
+      self.sums[slot] = np.where(present, t, sums)
+      self.compensation[slot] = np.where(present, compensation, self.compensation[slot])
+
+  def result(self, name):
+    df = pd.concat([pd.DataFrame(self.sums, index=self.keys, columns=self.float_columns),
+                    pd.DataFrame(self.int_sums, index=self.keys, columns=self.int_columns)], axis=1)
+    df.index.name = name
+    return df[self.columns].sort_index()
+
+
+def sum_parquet_timeseries(files, index_col, drops):
+  # Sum the parquet/timeseries group files by time, one cluster of overlapping buildings at a time and reading
+  # only the value columns, in the order the concat/sort_values(['building_id', 'time'])/groupby would
+  if not files:
+    return None
+
+  # Groups may not all report the same end uses, so project onto the union of their schemas; a column is only an
+  # integer column if every group has it as one, otherwise the concat would have made it float
+  schemas = [pq.read_schema(file) for file in files]
+  schema = pa.unify_schemas(schemas, promote_options='permissive')
+  skips = set(index_col + drops + ['building_id', 'upgrade'])
+  columns = [col for col in schema.names if col not in skips and not col.startswith('__index_level_')]
+  int_columns = [col for col in columns if all(col in s.names and pa.types.is_integer(s.field(col).type) for s in schemas)]
+
+  total = OrderedGroupSum(columns, int_columns)
+  for cluster in building_clusters(files):
+    df = pd.concat([ds.dataset(file, schema=schema, format='parquet').to_table(columns=['building_id'] + index_col + columns).to_pandas(ignore_metadata=True) for file in cluster])
+    df = df.sort_values('building_id', kind='stable')
+    total.add(df[index_col[0]].to_numpy(), df)
+
+  return total.result(index_col[0])
+
+
+def write_results(df, file):
+  # Write the csv along with a columnar parquet sidecar, which BaseCompare reads in preference to the csv
+  df.to_csv(file)
+
+  # Each project's results infer their dtypes separately, so a concatenated column can mix, e.g., ints and strings
+  # ("10+"); write those as the strings the csv holds, keeping missing values
+  columnar = df.copy()
+  for col in columnar.columns[columnar.dtypes == object]:
+    values = columnar[col]
+    columnar[col] = values.where(values.isna(), values.astype(str))
+
+  columnar_file = os.path.splitext(file)[0] + '.parquet'
+  try:
+    table = pa.Table.from_pandas(columnar)
+    table = table.replace_schema_metadata({**table.schema.metadata, **columnar_metadata(file)})
+    pq.write_table(table, columnar_file)
+  except (pa.ArrowException, ValueError) as e:
+    # The csv alone is still complete; don't leave an outdated sidecar behind
+    print('Skipping {}: {}'.format(columnar_file, e))
+    if os.path.exists(columnar_file):
+      os.remove(columnar_file)
+
+
+def has_timeseries(dp_dir):
+  return os.path.isfile(os.path.join(dp_dir, 'run', 'results_timeseries.csv'))
+
+
+def scan_simulation_output(upgrade_dir):
+  # Datapoints of one simulation_output/upXX directory that produced a results_timeseries.csv, and those that did not
+  # (yet); a file appearing in run/ does not change the upXX mtime, so those are re-checked on every run
+  dps = []
+  pending = []
+  with os.scandir(upgrade_dir) as entries:
+    for entry in entries:
+      if entry.is_dir():
+        (dps if has_timeseries(entry.path) else pending).append(entry.name)
+  return sorted(dps), sorted(pending)
+
+
+def rescan_simulation_output(upgrade_dir, entry):
+  found = [dp for dp in entry['pending'] if has_timeseries(os.path.join(upgrade_dir, dp))]
+  if not found:
+    return entry
+  return {'mtime': entry['mtime'],
+          'files': sorted(entry['files'] + found),
+          'pending': [dp for dp in entry['pending'] if dp not in found]}
+
+
+def scan_parquet(upgrade_dir):
+  # Group files of one parquet/timeseries/upgrade=N directory
+  with os.scandir(upgrade_dir) as entries:
+    return sorted(entry.name for entry in entries if entry.is_file()), []
+
+
+def index_output(output_dir, cache_folder=None):
+  # Crawl each upgrade directory of a buildstockbatch output directory once. With a cache folder, what was found is
+  # kept in a small manifest keyed by each upgrade directory's mtime, so repeated runs on the same output skip the crawl
+  index_path = None
+  cached = {}
+  if cache_folder:
+    index_path = os.path.join(cache_folder, 'index_{}.json'.format(hashlib.sha1(os.path.abspath(output_dir).encode()).hexdigest()))
+    if os.path.exists(index_path):
+      with open(index_path) as f:
+        cached = json.load(f)
+
+  index = {}
+  for key, parent, scan, rescan in [('simulation_output', os.path.join(output_dir, 'simulation_output'), scan_simulation_output, rescan_simulation_output),
+                                    ('parquet', os.path.join(output_dir, 'parquet', 'timeseries'), scan_parquet, None)]:
+    index[key] = {}
+    if not os.path.isdir(parent):
+      continue
+
+    with os.scandir(parent) as entries:
+      for entry in entries:
+        if not entry.is_dir():
+          continue
 
-    results_characteristics = results_characteristics.set_index('OSW')
-    results_characteristics = results_characteristics.sort_index()
-    results_characteristics.to_csv(os.path.join(outdir, 'results_characteristics.csv'))
+        mtime = entry.stat().st_mtime_ns
+        entry_cache = cached.get(key, {}).get(entry.name)
+        if entry_cache and entry_cache['mtime'] == mtime and 'pending' in entry_cache:
+          index[key][entry.name] = rescan(entry.path, entry_cache) if rescan else entry_cache
+        else:
+          files, pending = scan(entry.path)
+          index[key][entry.name] = {'mtime': mtime, 'files': files, 'pending': pending}
 
-    # results_output.csv
-    results_output = df[['OSW'] + report_simulation_outputs + report_utility_bills + upgrade_costs + qoi_reports]
-    results_output = results_output.dropna(how='all', axis=1)
+  if index_path and index != cached:
+    if not os.path.exists(cache_folder):
+      os.makedirs(cache_folder)
+    with open(index_path, 'w') as f:
+      json.dump(index, f, indent=2, sort_keys=True)
 
-    results_output = results_output.set_index('OSW')
-    results_output = results_output.sort_index()
-    results_output.to_csv(os.path.join(outdir, 'results_output.csv'))
+  return index
 
-    # Timeseries
 
-    outdir = 'baseline/timeseries'
-    if not os.path.exists(outdir):
-      os.makedirs(outdir)
+def simulation_output_datapoints(index, upgrade):
+  up = 'up{}'.format('%02d' % upgrade)
+  return index['simulation_output'].get(up, {}).get('files', [])
 
-    # results_output.csv
-
-    df_nationals = []
-    df_testings = []
-    index_col = ['Time']
-    drops = ['TimeDST', 'TimeUTC']
 
-    dps = sorted(os.listdir('project_national/national_baseline/simulation_output/up00'))
-    for dp in dps:
-      df_national = read_csv('project_national/national_baseline/simulation_output/up00/{}/run/results_timeseries.csv'.format(dp), index_col=index_col, skiprows=[1])
-      df_national = df_national.drop(drops, axis=1)
-      df_nationals.append(df_national)
+def parquet_files(output_dir, index, upgrades):
+  # Each group file across the upgrades, then the next group, which is the order the group files were concatenated in
+  partitions = {upgrade: index['parquet'].get('upgrade={}'.format(upgrade), {}).get('files', []) for upgrade in upgrades}
+  files = []
+  for group in sorted(set(group for groups in partitions.values() for group in groups)):
+    for upgrade in upgrades:
+      if group in partitions[upgrade]:
+        files.append(os.path.join(output_dir, 'parquet', 'timeseries', 'upgrade={}'.format(upgrade), group))
+  return files
+
+
+class PartialCache:
+  # Manifest of input file size/mtime/content hash and the partial aggregates derived from them, so a re-run only
+  # recomputes the project/upgrade slices whose inputs changed. Without a cache folder every slice is computed.
+  version = 1
+
+  def __init__(self, cache_folder=None):
+    self.cache_folder = cache_folder
+    self.manifest = {'files': {}, 'slices': {}}
+
+    if not cache_folder:
+      return
+
+    if not os.path.exists(cache_folder):
+      os.makedirs(cache_folder)
+
+    manifest_path = os.path.join(cache_folder, 'manifest.json')
+    if os.path.exists(manifest_path):
+      with open(manifest_path) as f:
+        self.manifest = json.load(f)
+
+  def file_hash(self, file):
+    # Only re-hash contents when the size or mtime changed since the last run
+    stat = os.stat(file)
+    entry = self.manifest['files'].get(file)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+      return entry['hash']
+
+    sha = hashlib.sha1()
+    with open(file, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b''):
+        sha.update(block)
+
+    self.manifest['files'][file] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': sha.hexdigest()}
+    return sha.hexdigest()
+
+  def partial_file(self, key):
+    return os.path.join(self.cache_folder, '{}.pkl'.format(hashlib.sha1(key.encode()).hexdigest()))
+
+  def digest(self, files):
+    sha = hashlib.sha1(str(self.version).encode())
+    for file in files:
+      sha.update(file.encode())
+      sha.update(self.file_hash(file).encode())
+    return sha.hexdigest()
+
+  def lookup(self, key, files):
+    # Returns (hit, partial, digest)
+    if not self.cache_folder:
+      return (False, None, None)
+
+    digest = self.digest(files)
+    entry = self.manifest['slices'].get(key)
+    if entry and entry['digest'] == digest and os.path.exists(self.partial_file(key)):
+      return (True, pd.read_pickle(self.partial_file(key)), digest)
+
+    return (False, None, digest)
+
+  def store(self, key, digest, df):
+    if not self.cache_folder:
+      return
+
+    pd.to_pickle(df, self.partial_file(key))
+    self.manifest['slices'][key] = {'digest': digest, 'partial': os.path.basename(self.partial_file(key))}
+
+  def save(self):
+    if not self.cache_folder:
+      return
+
+    with open(os.path.join(self.cache_folder, 'manifest.json'), 'w') as f:
+      json.dump(self.manifest, f, indent=2, sort_keys=True)
+
+
+class Project:
+  def __init__(self, output_dir, color_index, cache_folder=None):
+    # e.g., project_national/national_baseline -> project_national
+    self.output_dir = output_dir
+    self.name = os.path.basename(os.path.dirname(os.path.abspath(output_dir)))
+    self.color_index = color_index
+    self.index = index_output(output_dir, cache_folder)
+
+    results_csvs = os.path.join(output_dir, 'results_csvs')
+    self.num_scenarios = len([file for file in os.listdir(results_csvs) if file.startswith('results_up')])
+
+
+class ColumnClassifier:
+  # Maps result columns to their group (or "excluded") with one precompiled pattern per rule set. Classifications
+  # are cached per header signature, since results_upXX.csv files of an analysis share the same headers.
+  groups = ['build_existing_model',
+            'report_simulation_output',
+            'report_utility_bills',
+            'upgrade_costs',
+            'qoi_report']
+
+  def __init__(self, exclusions):
+    self.exclusion_pattern = re.compile('|'.join(re.escape(exclusion) for exclusion in exclusions))
+    self.group_pattern = re.compile('^({})'.format('|'.join(re.escape(group) for group in self.groups)))
+
+  @functools.lru_cache(maxsize=None)
+  def classify(self, columns):
+    # columns is a tuple of column names; returns {group: tuple of columns}
+    classes = {group: [] for group in self.groups + ['excluded']}
+    for col in columns:
+      if self.exclusion_pattern.search(col):
+        classes['excluded'].append(col)
+        continue
 
-    dps = sorted(os.listdir('project_testing/testing_baseline/simulation_output/up00'))
+      match = self.group_pattern.match(col)
+      if match:
+        classes[match.group(1)].append(col)
+
+    return {group: tuple(cols) for group, cols in classes.items()}
+
+
+class BSBAnalysis:
+  # Aggregates buildstockbatch output directories of any number of projects into the baseline/upgrades
+  # results_characteristics.csv, results_output.csv, and buildstockbatch.csv files used by compare.py.
+  # Slices of every project are submitted to one shared process pool up front, so projects are processed
+  # concurrently; results_timeseries.csv files are summed by the pool in contiguous runs, or, in exact mode, parsed by
+  # the pool and summed here one file at a time in the original file order.
+  col_exclusions = ['applicable',
+                    'include_annual_',
+                    'include_timeseries_',
+                    'output_format',
+                    'timeseries_frequency',
+                    'timestamp_convention',
+                    'timeseries_num_decimal_places',
+                    'upgrade_name',
+                    'add_timeseries_',
+                    'user_output_variables',
+                    'debug',
+                    'include_monthly_',
+                    'register_annual_',
+                    'register_monthly_']
+  classifier = ColumnClassifier(col_exclusions)
+
+  def __init__(self, cache_folder=None, jobs=1, exact=False):
+    self.cache = PartialCache(cache_folder)
+    self.jobs = jobs
+    self.exact = exact
+    self.executor = None
+
+  def __enter__(self):
+    if self.jobs > 1:
+      self.executor = ProcessPoolExecutor(max_workers=self.jobs)
+    return self
+
+  def __exit__(self, *args):
+    if self.executor:
+      self.executor.shutdown()
+      self.executor = None
+    self.cache.save()
+
+  def submit(self, project, kind, upgrade, files, func, *args, reader=None):
+    # Returns a pending slice; func(files, *args) returns its aggregate. With a pool, a slice with a reader can be
+    # summed in parts: the workers run func on contiguous runs of its files and the partial sums are added here in
+    # order. In exact mode the workers only run reader(file, *args) and every frame is added here in file order, the
+    # same order as func, so the floating point sums don't depend on the number of jobs.
+    key = '{}|{}|{}'.format(project.output_dir, kind, upgrade)
+    size = None
+    if self.executor and reader is not None and not self.exact:
+      # About four runs per worker; the runs change the summation order, so they get their own cache entry
+      size = max(1, -(-len(files) // (4 * self.jobs)))
+      key = '{}|{}'.format(key, size)
+    hit, df, digest = self.cache.lookup(key, files)
+    if hit:
+      return {'df': df}
+
+    if not self.executor or not files:
+      df = func(files, *args) if files else None
+      self.cache.store(key, digest, df)
+      return {'df': df}
+
+    if reader is None:
+      return {'key': key, 'digest': digest, 'frames': iter([self.executor.submit(func, files, *args)])}
+    if size is not None:
+      return {'key': key, 'digest': digest, 'frames': [self.executor.submit(func, files[i:i + size], *args) for i in range(0, len(files), size)]}
+    return {'key': key, 'digest': digest, 'frames': self.ordered_map(reader, files, *args)}
+
+  def ordered_map(self, reader, files, *args):
+    # Submit files lazily, keeping a few per worker in flight, and yield the frames in file order
+    futures = deque()
+    for file in files:
+      futures.append(self.executor.submit(reader, file, *args))
+      if len(futures) >= 4 * self.jobs:
+        yield futures.popleft()
+    while futures:
+      yield futures.popleft()
+
+  def result(self, pending):
+    if 'df' not in pending:
+      pending['df'] = accumulate(future.result() for future in pending['frames'])
+      self.cache.store(pending['key'], pending['digest'], pending['df'])
+    return pending['df']
+
+  def submit_results(self, project, upgrade):
+    files = [os.path.join(project.output_dir, 'results_csvs', 'results_up{}.csv'.format('%02d' % upgrade))]
+    return self.submit(project, 'annual', upgrade, files, read_results)
+
+  def submit_timeseries(self, project, upgrades):
+    # One slice over all upgrades: each up00 datapoint's results for every upgrade, then the next datapoint, which is
+    # the order the frames were originally summed in
+    up00 = project.index['simulation_output'].get('up00', {})
+    dps = sorted(up00.get('files', []) + up00.get('pending', []))
+    upgrade_dps = {upgrade: set(simulation_output_datapoints(project.index, upgrade)) for upgrade in upgrades}
+    files = []
     for dp in dps:
-      df_testing = read_csv('project_testing/testing_baseline/simulation_output/up00/{}/run/results_timeseries.csv'.format(dp), index_col=index_col, skiprows=[1])
-      df_testing = df_testing.drop(drops, axis=1)
-      df_testings.append(df_testing)
-
-    df_national = reduce(lambda x, y: x.add(y, fill_value=0), df_nationals).round(1)
-    df_national['PROJECT'] = 'project_national'
-
-    df_testing = reduce(lambda x, y: x.add(y, fill_value=0), df_testings).round(1)
-    df_testing['PROJECT'] = 'project_testing'
-
-    results_output = pd.concat([df_national, df_testing]).fillna(0)
-    results_output = results_output.reset_index().set_index('PROJECT')
-    results_output = results_output.sort_index()
-    results_output = results_output.reindex(index_col + sorted(results_output.columns.drop(index_col)), axis=1)
-    results_output.to_csv(os.path.join(outdir, 'results_output.csv'))
+      for upgrade in upgrades:
+        if dp in upgrade_dps[upgrade]:
+          files.append(os.path.join(project.output_dir, 'simulation_output', 'up{}'.format('%02d' % upgrade), dp, 'run', 'results_timeseries.csv'))
+    upgrade = ','.join(str(upgrade) for upgrade in upgrades)
+    return self.submit(project, 'timeseries', upgrade, files, sum_timeseries, ['Time'], ['TimeDST', 'TimeUTC'], reader=read_timeseries)
 
-    # buildstockbatch.csv
+  def submit_parquet(self, project, upgrades):
+    # One slice over all upgrades; the summation order spans upgrades, so the files can't be split across workers
+    files = parquet_files(project.output_dir, project.index, list(upgrades))
+    upgrade = ','.join(str(upgrade) for upgrade in upgrades)
+    return self.submit(project, 'buildstockbatch', upgrade, files, sum_parquet_timeseries, ['time'], ['timedst', 'timeutc'])
 
-    df_nationals = []
-    df_testings = []
-    index_col = ['time']
-    drops = ['timedst', 'timeutc']
+  def classify_columns(self, df, baseline):
+    classes = self.classifier.classify(tuple(df.columns))
 
-    groups = sorted(os.listdir('project_national/national_baseline/parquet/timeseries/upgrade=0'))
-    for group in groups:
-        df_national = pd.read_parquet('project_national/national_baseline/parquet/timeseries/upgrade=0/{}'.format(group)).reset_index()
-        df_national = df_national.drop(drops, axis=1)
-        df_nationals.append(df_national)
-
-    groups = sorted(os.listdir('project_testing/testing_baseline/parquet/timeseries/upgrade=0'))
-    for group in groups:
-        df_testing = pd.read_parquet('project_testing/testing_baseline/parquet/timeseries/upgrade=0/{}'.format(group)).reset_index()
-        df_testing = df_testing.drop(drops, axis=1)
-        df_testings.append(df_testing)
-
-    df_national = pd.concat(df_nationals).sort_values(['building_id', 'time'])
-    df_national = df_national.drop(['building_id'], axis=1)
-    df_national = df_national.groupby(index_col).sum().round(1)
-    df_national['PROJECT'] = 'project_national'
-
-    df_testing = pd.concat(df_testings).sort_values(['building_id', 'time'])
-    df_testing = df_testing.drop(['building_id'], axis=1)
-    df_testing = df_testing.groupby(index_col).sum().round(1)
-    df_testing['PROJECT'] = 'project_testing'
-
-    buildstockbatch = pd.concat([df_national, df_testing]).fillna(0)
-    buildstockbatch = buildstockbatch.reset_index().set_index('PROJECT')
-    buildstockbatch = buildstockbatch.sort_index()
-    buildstockbatch = buildstockbatch.reindex(index_col + sorted(buildstockbatch.columns.drop(index_col)), axis=1)
-    buildstockbatch.to_csv(os.path.join(outdir, 'buildstockbatch.csv'))
-
-    # UPGRADES
+    build_existing_models = []
+    if baseline:
+      build_existing_models = sorted(classes['build_existing_model'])
 
-    if not os.path.exists('upgrades'):
-      os.makedirs('upgrades')
+    upgrade_costs = classes['upgrade_costs']
+    if baseline:
+      upgrade_costs = [col for col in upgrade_costs if not 'upgrade_cost_usd' in col]
 
-    # Annual
+    report_simulation_outputs = ['color_index'] + list(classes['report_simulation_output'])
+    outputs = sorted(report_simulation_outputs) + sorted(classes['report_utility_bills']) + sorted(upgrade_costs) + sorted(classes['qoi_report'])
+    return build_existing_models, outputs
 
-    outdir = 'upgrades/annual'
+  def write_annual(self, frames, outdir, baseline):
     if not os.path.exists(outdir):
       os.makedirs(outdir)
 
-    frames = []
-
-    national_num_scenarios = sum([len(files) for r, d, files in os.walk('project_national/national_upgrades/results_csvs')])
-    testing_num_scenarios = sum([len(files) for r, d, files in os.walk('project_testing/testing_upgrades/results_csvs')])
-    assert national_num_scenarios == testing_num_scenarios
-
-    for i in range(1, national_num_scenarios):
-
-      df_national = read_csv('project_national/national_upgrades/results_csvs/results_up{}.csv'.format('%02d' % i))
-      df_testing = read_csv('project_testing/testing_upgrades/results_csvs/results_up{}.csv'.format('%02d' % i))
-
-      assert df_national['apply_upgrade.upgrade_name'][0] == df_testing['apply_upgrade.upgrade_name'][0]
-      upgrade_name = df_national['apply_upgrade.upgrade_name'][0]
-
-      df_national['building_id'] = df_national['building_id'].apply(lambda x: 'project_national-{}-{}.osw'.format(upgrade_name, '%04d' % x))
-      df_national.insert(1, 'color_index', 1)
-
-      frames.append(df_national)
-      
-      df_testing['building_id'] = df_testing['building_id'].apply(lambda x: 'project_testing-{}-{}.osw'.format(upgrade_name, '%04d' % x))
-      df_testing.insert(1, 'color_index', 0)
-
-      frames.append(df_testing)
-
     df = pd.concat(frames)
     df = df.rename(columns={'building_id': 'OSW'})
     del df['job_id']
 
-    report_simulation_outputs = ['color_index']
-    report_utility_bills = []
-    upgrade_costs = []
-    qoi_reports = []
-
-    for col in df.columns.values:
-      if any([col_exclusion in col for col_exclusion in col_exclusions]):
-        continue
+    build_existing_models, outputs = self.classify_columns(df, baseline)
 
-      if col.startswith('report_simulation_output'):
-        report_simulation_outputs.append(col)
-      elif col.startswith('report_utility_bills'):
-        report_utility_bills.append(col)
-      elif col.startswith('upgrade_costs'):
-        upgrade_costs.append(col)
-      elif col.startswith('qoi_report'):
-        qoi_reports.append(col)
+    # results_characteristics.csv
+    if baseline:
+      results_characteristics = df[['OSW'] + build_existing_models]
 
-    report_simulation_outputs = sorted(report_simulation_outputs)
-    report_utility_bills = sorted(report_utility_bills)
-    upgrade_costs = sorted(upgrade_costs)
-    qoi_reports = sorted(qoi_reports)
+      results_characteristics = results_characteristics.set_index('OSW')
+      results_characteristics = results_characteristics.sort_index()
+      write_results(results_characteristics, os.path.join(outdir, 'results_characteristics.csv'))
 
     # results_output.csv
-    results_output = df[['OSW'] + report_simulation_outputs + report_utility_bills + upgrade_costs + qoi_reports]
+    results_output = df[['OSW'] + outputs]
     results_output = results_output.dropna(how='all', axis=1)
 
     results_output = results_output.set_index('OSW')
     results_output = results_output.sort_index()
-    results_output.to_csv(os.path.join(outdir, 'results_output.csv'))
-
-    # Timeseries
+    write_results(results_output, os.path.join(outdir, 'results_output.csv'))
+
+  def write_timeseries(self, projects, pendings, index_col, file):
+    dfs = []
+    for project in projects:
+      df = accumulate(self.result(pending) for pending in pendings[project.output_dir]).round(1)
+      df['PROJECT'] = project.name
+      dfs.append(df)
+
+    df = pd.concat(dfs).fillna(0)
+    df = df.reset_index().set_index('PROJECT')
+    df = df.sort_index(kind='stable')
+    df = df.reindex(index_col + sorted(df.columns.drop(index_col)), axis=1)
+    write_results(df, file)
+
+  def process(self, output_dirs, outdir, upgrades_fn, baseline):
+    # The color index of each project is its position in output_dirs
+    projects = [Project(output_dir, color_index, self.cache.cache_folder) for color_index, output_dir in enumerate(output_dirs)]
+
+    # Queue every slice of every project up front so the pool works on all projects at once; in exact mode the
+    # results_timeseries.csv files are instead submitted as write_timeseries sums them, one project at a time
+    results = {}
+    timeseries = {}
+    parquets = {}
+    for project in projects:
+      upgrades = upgrades_fn(project)
+      results[project.output_dir] = [(upgrade, self.submit_results(project, upgrade)) for upgrade in upgrades]
+      timeseries[project.output_dir] = [self.submit_timeseries(project, upgrades)]
+      parquets[project.output_dir] = [self.submit_parquet(project, upgrades)]
 
-    outdir = 'upgrades/timeseries'
-    if not os.path.exists(outdir):
-      os.makedirs(outdir)
-
-    # results_output.csv
-
-    df_nationals = []
-    df_testings = []
-    index_col = ['Time']
-    drops = ['TimeDST', 'TimeUTC']
+    # Annual
+    frames = []
+    for project in projects:
+      for upgrade, pending in results[project.output_dir]:
+        df = self.result(pending).copy()
+        if baseline:
+          df['building_id'] = df['building_id'].apply(lambda x: '{}-{}.osw'.format(project.name, '%04d' % x))
+        else:
+          upgrade_name = df['apply_upgrade.upgrade_name'][0]
+          df['building_id'] = df['building_id'].apply(lambda x: '{}-{}-{}.osw'.format(project.name, upgrade_name, '%04d' % x))
+        df.insert(1, 'color_index', project.color_index)
+        frames.append(df)
+
+    self.write_annual(frames, os.path.join(outdir, 'annual'), baseline)
 
-    dps = sorted(os.listdir('project_national/national_upgrades/simulation_output/up00'))
-    for dp in dps:
-      for i in range(1, national_num_scenarios):
-        if not os.path.exists('project_national/national_upgrades/simulation_output/up{}/{}/run/results_timeseries.csv'.format('%02d' % i, dp)):
-          continue
+    # Timeseries
+    ts_outdir = os.path.join(outdir, 'timeseries')
+    if not os.path.exists(ts_outdir):
+      os.makedirs(ts_outdir)
 
-        df_national = read_csv('project_national/national_upgrades/simulation_output/up{}/{}/run/results_timeseries.csv'.format('%02d' % i, dp), index_col=index_col, skiprows=[1])
-        df_national = df_national.drop(drops, axis=1)
-        df_nationals.append(df_national)
+    self.write_timeseries(projects, timeseries, ['Time'], os.path.join(ts_outdir, 'results_output.csv'))
+    self.write_timeseries(projects, parquets, ['time'], os.path.join(ts_outdir, 'buildstockbatch.csv'))
 
-    dps = sorted(os.listdir('project_testing/testing_upgrades/simulation_output/up00'))
-    for dp in dps:
-      for i in range(1, testing_num_scenarios):
-        if not os.path.exists('project_testing/testing_upgrades/simulation_output/up{}/{}/run/results_timeseries.csv'.format('%02d' % i, dp)):
-          continue
+  def process_baseline(self, output_dirs, outdir='baseline'):
+    self.process(output_dirs, outdir, lambda project: [0], True)
 
-        df_testing = read_csv('project_testing/testing_upgrades/simulation_output/up{}/{}/run/results_timeseries.csv'.format('%02d' % i, dp), index_col=index_col, skiprows=[1])
-        df_testing = df_testing.drop(drops, axis=1)
-        df_testings.append(df_testing)
+  def process_upgrades(self, output_dirs, outdir='upgrades'):
+    self.process(output_dirs, outdir, lambda project: range(1, project.num_scenarios), False)
 
-    df_national = reduce(lambda x, y: x.add(y, fill_value=0), df_nationals).round(1)
-    df_national['PROJECT'] = 'project_national'
 
-    df_testing = reduce(lambda x, y: x.add(y, fill_value=0), df_testings).round(1)
-    df_testing['PROJECT'] = 'project_testing'
+if __name__ == '__main__':
 
-    results_output = pd.concat([df_national, df_testing]).fillna(0)
-    results_output = results_output.reset_index().set_index('PROJECT')
-    results_output = results_output.sort_index()
-    results_output = results_output.reindex(index_col + sorted(results_output.columns.drop(index_col)), axis=1)
-    results_output.to_csv(os.path.join(outdir, 'results_output.csv'))
-
-    # buildstockbatch.csv
-
-    df_nationals = []
-    df_testings = []
-    index_col = ['time']
-    drops = ['timedst', 'timeutc']
-
-    groups = sorted(os.listdir('project_national/national_baseline/parquet/timeseries/upgrade=0'))
-    for group in groups:
-        for i in range(1, national_num_scenarios):
-            if not os.path.exists('project_national/national_upgrades/parquet/timeseries/upgrade={}/{}'.format(i, group)):
-                continue
-
-            df_national = pd.read_parquet('project_national/national_upgrades/parquet/timeseries/upgrade={}/{}'.format(i, group)).reset_index()
-            df_national = df_national.drop(drops, axis=1)
-            df_nationals.append(df_national)
-
-    groups = sorted(os.listdir('project_testing/testing_baseline/parquet/timeseries/upgrade=0'))
-    for group in groups:
-        for i in range(1, testing_num_scenarios):
-            if not os.path.exists('project_testing/testing_upgrades/parquet/timeseries/upgrade={}/{}'.format(i, group)):
-                continue
-
-            df_testing = pd.read_parquet('project_testing/testing_upgrades/parquet/timeseries/upgrade={}/{}'.format(i, group)).reset_index()
-            df_testing = df_testing.drop(drops, axis=1)
-            df_testings.append(df_testing)
-
-    df_national = pd.concat(df_nationals).sort_values(['building_id', 'time'])
-    df_national = df_national.drop(['building_id'], axis=1)
-    df_national = df_national.groupby(index_col).sum().round(1)
-    df_national['PROJECT'] = 'project_national'
-
-    df_testing = pd.concat(df_testings).sort_values(['building_id', 'time'])
-    df_testing = df_testing.drop(['building_id'], axis=1)
-    df_testing = df_testing.groupby(index_col).sum().round(1)
-    df_testing['PROJECT'] = 'project_testing'
-
-    buildstockbatch = pd.concat([df_national, df_testing]).fillna(0)
-    buildstockbatch = buildstockbatch.reset_index().set_index('PROJECT')
-    buildstockbatch = buildstockbatch.sort_index()
-    buildstockbatch = buildstockbatch.reindex(index_col + sorted(buildstockbatch.columns.drop(index_col)), axis=1)
-    buildstockbatch.to_csv(os.path.join(outdir, 'buildstockbatch.csv'))
+  # The position of a project in the list sets its color_index
+  default_baseline_dirs = ['project_testing/testing_baseline', 'project_national/national_baseline']
+  default_upgrade_dirs = ['project_testing/testing_upgrades', 'project_national/national_upgrades']
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-b', '--baseline_dirs', nargs='+', default=default_baseline_dirs, help='The buildstockbatch output directories of the baseline projects.')
+  parser.add_argument('-u', '--upgrade_dirs', nargs='+', default=default_upgrade_dirs, help='The buildstockbatch output directories of the upgrade projects.')
+  parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes used to parse results files.')
+  parser.add_argument('-x', '--exact', action='store_true', help='Sum results_timeseries.csv files one at a time in file order, so the output does not depend on --jobs.')
+  parser.add_argument('-c', '--cache_folder', help='Folder for the input manifest, output directory indexes and cached partial aggregates; enables incremental re-processing.')
+  args = parser.parse_args()
+
+  with BSBAnalysis(args.cache_folder, args.jobs, args.exact) as analysis:
+    analysis.process_baseline(args.baseline_dirs)
+    analysis.process_upgrades(args.upgrade_dirs)